@@ -28,6 +28,11 @@ ju.start_pump()
 temp = 31.3				 # max 2 decimals accepted, rest will be rounded
 ju.changet(temp)
 
+#%% Wait until the bath is at temperature
+
+# Instead of time.sleep() for a guessed time: returns as soon as the temperature did not move more than 0.05 deg C for 5 minutes.
+ju.wait_until_stable(tolerance=0.05, window=300, target=temp)
+
 #%% Set tempramp
 
 Tinit = 31.30       	 	# Typical value: 31.8
@@ -37,6 +42,14 @@ totaltime = 9000     	 	# In seconds, typically domething like 7200 sec (3600 se
 
 ju.ramp(Tinit,Tend,dT,totaltime)
 
+#%% Run a temperature profile
+
+# Jumps between 30 and 32.5 deg C every hour, 24 times, and then ramps down to 20 deg C in 2 hours.
+profile = Temperature_profile(30)
+profile.hold(60*60*1).step(32.5,60*60*1).repeat(24)
+profile.ramp(20,60*60*2)
+ju.run_profile(profile)
+
 #%% Do other random other stuff
  
 # This makes it jump between two temperatures every hour until you manually stop the script using ctrl+c.
@@ -21,11 +21,9 @@ machine we want to use to a variable with the correct comport (see devices and p
 We can then trun on the pump by running self.start_pump(), set the temperature using self.changet(temp), and ramp the temperature using self.ramp(Tinit,Tend,dT,totaltime). All classes work exactly the same, although not all functionality is implemented in all classes.
 
 Guide for adding new machines:
-    * Every class should *at least* contain a function:
-            - _readtemp_set (okay, not really, but is really inconvenient not to have this (looking at you electrical heating system)
-            - _set_temperature
-            These functions should contain a call to _in_command and _out command respectively, with the command found in the manual of the machine in question.
-    * Let the class inherit from the metaclass Temperature_controller, or, if we allready have a controller from the brand, the brand metaclass (i.e. 'haake').
+    * Describe how to talk to it with register_protocol(): serial settings, and the commands found in the manual of the machine in question (at least 'read_set' and 'set_temperature'), see PROTOCOLS for the ones we have.
+    * If it talks like the others, controller_class('[protocol name]') gives you a class for it, and you are done.
+    * Otherwise, make a class that inherits from the metaclass Temperature_controller, or, if we allready have a controller from the brand, the brand metaclass (i.e. 'haake'). Give it protocol = '[protocol name]', call self._connect() in __init__, and override what is different (like a parser for the replies).
     * Stuff should now work automatically
 
 Random Notes:
@@ -48,6 +46,39 @@ import math
 import sys
 import datetime
 import logging
+import struct
+import threading
+import collections
+import re
+import heapq
+import contextlib
+import itertools
+import functools
+import json
+import os
+import concurrent.futures
+
+# One parsed reply of a device, see Temperature_controller._parse_replies().
+# status is 'value' (value is the number as a float), 'ack' (device says OK),
+# 'no_sensor' (nothing connected to read from) or 'error' (error is the error 
+# code, or the raw reply if we don't understand it).
+Reply = collections.namedtuple('Reply',['value','status','error'])
+
+# How replies look, one complete reply (including terminator) per match. The 
+# named group that matched tells what kind of reply it is.
+_JULABO_REPLY = re.compile(rb'[ \t]*(?:(?P<value>[-+]?\d+(?:\.\d*)?)|(?P<no_sensor>-+\.-+)|(?P<other>[^\r\n]*?))[ \t]*\r?\n')
+_HAAKE_REPLY = re.compile(rb'(?:[A-Z][A-Z0-9]?)?(?:(?P<value>[-+]?\d+\.\d+)|(?P<other>[^$]*?))\$\r\n')
+_LAUDA_REPLY = re.compile(rb'[ \t]*(?:(?P<value>[-+]?\d+(?:\.\d*)?)|(?P<ack>OK)|(?P<error>E[Rr][Rr]_\d+)|(?P<other>[^\r\n]*?))[ \t]*\r\n')
+# Julabo sets the parity bit by hand (b'\xb26.33\x8d\n' is '26.33\r\n'), 
+# bytes.translate() with this table removes it.
+_STRIP_PARITY = bytes(b & 0x7f for b in range(256))
+
+# Who goes first if several threads want to use the same comport, see 
+# Port_queue. Lower goes first.
+PRIORITY_SAFETY = 0         # stop_pump(), alarm()
+PRIORITY_SETPOINT = 1       # changet() and friends
+PRIORITY_COMMAND = 2        # Everything else you type in the console
+PRIORITY_TELEMETRY = 3      # Reading on the background (acquisition, keepalive, server)
 
 def find_available_comports(helpme=False):
     '''
@@ -73,8 +104,998 @@ def find_available_comports(helpme=False):
               "description tells you what is attached to the PC. In this case "
               "we are looking for somethin along the lines of 'USB-to-Serial "
               "converter'. Remember the corresponding COMport name, and input "
-              "that into the regular script. And that's it. Easypeasy." )
+              "that into the regular script. And that's it. Easypeasy. Or "
+              "let discover() find out which waterbath is where." )
+        
+
+# Which protocol we found on which adapter, see discover(). Delete this file 
+# (or use discover(cache=None)) if you moved the waterbaths around.
+DISCOVERY_CACHE = os.path.join(os.path.expanduser('~'),'.classywaterbaths_discovery.json')
+
+def discover(comports=None,protocols=None,timeout=0.5,cache=DISCOVERY_CACHE):
+    '''
+    Finds out which device is on which comport, so you don't have to try 
+    julabo('com3'), julabo('com4'), ... . Returns a dict of {comport : 
+    controller}, with a ready controller for every device found; 
+    controller.protocol tells you what it is.
+        * comports : comports to look at, all of find_available_comports() 
+          if None.
+        * protocols : names in PROTOCOLS to look for, all that have an 
+          identify_reply if None.
+        * timeout : time in seconds a device gets to answer one identify 
+          command.
+        * cache : JSON file that remembers which protocol was found on which
+          adapter (by serial number, or VID:PID if that is unique). Next time, 
+          a known adapter only gets the identify command of the remembered 
+          protocol, and is only probed for all protocols if it does not 
+          answer that. None to not use a cache.
+    All comports are probed at the same time (one thread per comport), the 
+    protocols of a comport one after the other, at their own baudrate etc..
+    '''
+    if comports is None:
+        comports = [port.device for port in serial.tools.list_ports.comports()]
+    if protocols is None:
+        protocols = [name for name,description in PROTOCOLS.items() 
+                     if description['attributes'].get('identify_reply') is not None]
+    if not comports:
+        return {}
+    keys = _adapter_keys(comports)
+    known = _load_cache(cache)
+
+    def find(comport):
+        cached = known.get(keys[comport])
+        if cached in protocols:
+            # One identify command to check the cache is still right, the 
+            # waterbaths may have been moved around
+            try:
+                if _probe(comport,cached,timeout):
+                    logging.info("Found %s at comport %s in the discovery cache", cached, comport)
+                    return controller_class(cached)(comport)
+                logging.info("Cached %s at comport %s does not answer, probing instead", cached, comport)
+            except Exception as e:
+                logging.info("Cached %s at comport %s does not work ('%s'), probing instead", cached, comport, e)
+        try:
+            for protocol in protocols:
+                if protocol != cached and _probe(comport,protocol,timeout):
+                    logging.info("Discovered %s at comport %s", protocol, comport)
+                    return controller_class(protocol)(comport)
+        except serial.SerialException:
+            logging.info("Could not open comport %s, skipping it", comport)
+            return None
+        logging.info("Nothing discovered at comport %s", comport)
+        return None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(comports)) as pool:
+        found = dict(zip(comports,pool.map(find,comports)))
+    controllers = {}
+    for comport,controller in found.items():
+        if controller is None:
+            continue
+        print("Found %s at comport %s" % (controller.protocol,comport))
+        controllers[comport] = controller
+        known[keys[comport]] = controller.protocol
+    _save_cache(cache,known)
+    return controllers
+
+
+def _probe(comport,protocol,timeout):
+    '''
+    True if the device at comport speaks protocol, see discover(). Only sends
+    the identify command, not the things the __init__ of a class may send.
+    Raises serial.SerialException if the comport can't be opened at all.
+    '''
+    cls = controller_class(protocol)
+    probe = cls.__new__(cls)
+    Temperature_controller.__init__(probe,comport)
+    open_port = serial.serial_for_url if '://' in comport else serial.Serial # see _initialize_connection()
+    probe.com = open_port(comport,**probe._serial_settings)
+    try:
+        return probe._identify(timeout)
+    except serial.SerialException:
+        logging.debug("Probing %s at comport %s failed", protocol, comport, exc_info=True)
+        return False
+    finally:
+        probe.closecom()
+
+
+def _adapter_keys(comports):
+    '''
+    Returns {comport : key} with what identifies the USB-serial adapter of 
+    every comport: its serial number, or VID:PID if no other adapter has the 
+    same one, or else the name of the comport.
+    '''
+    info = dict((port.device,port) for port in serial.tools.list_ports.comports())
+    vidpids = collections.Counter((port.vid,port.pid) for port in info.values() if port.vid is not None)
+    keys = {}
+    for comport in comports:
+        port = info.get(comport)
+        if port is not None and port.serial_number:
+            keys[comport] = 'SN:%s' % (port.serial_number,)
+        elif port is not None and port.vid is not None and vidpids[(port.vid,port.pid)] == 1:
+            keys[comport] = 'VID:PID:%04X:%04X' % (port.vid,port.pid)
+        else:
+            keys[comport] = 'PORT:%s' % (comport,)
+    return keys
+
+
+def _load_cache(cache):
+    '''
+    Returns the dict stored in JSON file cache (like DISCOVERY_CACHE), or an 
+    empty one if there is none (or cache is None).
+    '''
+    if cache is None or not os.path.exists(cache):
+        return {}
+    try:
+        with open(cache) as f:
+            return dict(json.load(f))
+    except (OSError,ValueError):
+        logging.warning("Could not read cache '%s', ignoring it", cache)
+        return {}
+
+
+def _save_cache(cache,data):
+    if cache is None:
+        return
+    try:
+        with open(cache,'w') as f:
+            json.dump(data,f,indent=1,sort_keys=True)
+    except OSError:
+        logging.warning("Could not write cache '%s'", cache)
+        
+
+# Every record in a wiretrace file starts with this: time (seconds since epoch),
+# direction ('>' or '<') and number of bytes that follow.
+_WIRETRACE_HEADER = struct.Struct('<dcI')
+
+def read_wiretrace(filename):
+    '''
+    Reads a file written by Temperature_controller.enable_wiretrace(filename),
+    returns a list of (time, direction, bytes).
+    '''
+    records = []
+    with open(filename,'rb') as f:
+        while True:
+            header = f.read(_WIRETRACE_HEADER.size)
+            if len(header) < _WIRETRACE_HEADER.size:
+                return records
+            t, direction, n = _WIRETRACE_HEADER.unpack(header)
+            records.append( (t,direction.decode(),f.read(n)) )
+
+
+class Port_queue():
+    '''
+    Makes the threads that want to use one comport take turns: one 
+    transaction (a command and its reply) at a time, and if several are 
+    waiting, the one with the highest priority goes first (see the PRIORITY_ 
+    constants, oldest first if equal). Use it as a lock:
+        with controller._lock:
+            ... talk to the device ...
+    The priority is that of the thread, set with priority(). A thread can 
+    take the lock again if it allready has it (like threading.RLock).
+    Get the queue of a comport with port_queue(comport), so all controllers
+    on the same comport share it.
+    '''
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._owner = None
+        self._count = 0
+        self._waiting = []      # heap of (priority, ticket)
+        self._tickets = itertools.count()
+        self._local = threading.local()
+    
+    def current_priority(self):
+        return getattr(self._local,'priority',PRIORITY_COMMAND)
+    
+    @contextlib.contextmanager
+    def priority(self,priority):
+        '''
+        Everything this thread sends within the with-block goes with priority
+        (or higher, if it was allready higher).
+        '''
+        previous = getattr(self._local,'priority',None)
+        self._local.priority = priority if previous is None else min(previous,priority)
+        try:
+            yield
+        finally:
+            if previous is None:
+                del self._local.priority
+            else:
+                self._local.priority = previous
+    
+    def acquire(self):
+        me = threading.get_ident()
+        with self._condition:
+            if self._owner == me:
+                self._count = self._count + 1
+                return
+            entry = (self.current_priority(),next(self._tickets))
+            heapq.heappush(self._waiting,entry)
+            while self._owner is not None or self._waiting[0] != entry:
+                self._condition.wait()
+            heapq.heappop(self._waiting)
+            self._owner = me
+            self._count = 1
+    
+    def release(self):
+        with self._condition:
+            if self._owner != threading.get_ident():
+                raise RuntimeError("Cannot release a port that is not ours")
+            self._count = self._count - 1
+            if self._count == 0:
+                self._owner = None
+                self._condition.notify_all()
+    
+    def __enter__(self):
+        self.acquire()
+        return self
+    
+    def __exit__(self,*exc):
+        self.release()
+    
+    def waiting(self):
+        '''
+        Number of transactions waiting for their turn.
+        '''
+        return len(self._waiting)
+
+
+_port_queues = {}
+_port_queues_lock = threading.Lock()
+
+def port_queue(comport):
+    '''
+    Returns the Port_queue of comport, made the first time you ask.
+    '''
+    with _port_queues_lock:
+        if comport not in _port_queues:
+            _port_queues[comport] = Port_queue()
+        return _port_queues[comport]
+
+
+def _with_priority(priority):
+    '''
+    Decorator for methods of Temperature_controller: everything the method 
+    sends goes with priority, see Port_queue.
+    '''
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(self,*args,**kwargs):
+            with self._lock.priority(priority):
+                return function(self,*args,**kwargs)
+        return wrapper
+    return decorate
+
+
+class _Request():
+    '''
+    A command that was sent and that the device will answer, see FrameDecoder.
+    wanted is True if somebody waits for the reply, False if it is just an
+    acknowledgement we should not mix up with other replies.
+    '''
+    def __init__(self,command,wanted):
+        self.command = command
+        self.wanted = wanted
+        self.frame = None
+
+
+class FrameDecoder():
+    '''
+    Turns the bytes coming from a device into complete frames (replies), as 
+    they come in, and gives every frame to the command that caused it. 
+    Devices answer in the order of the commands, so we keep a queue of the 
+    commands that still need an answer: the first frame that completes belongs
+    to the first command in the queue, and so on. That way, an 'OK' of an 
+    earlier command is never mistaken for the temperature we asked for, and we
+    don't have to throw away everything that comes in after every command.
+    cut_frames(buffer) should return (complete frames, rest), see 
+    Temperature_controller._cut_frames().
+    '''
+    def __init__(self,cut_frames):
+        self.cut_frames = cut_frames
+        self.buffer = b''
+        self.pending = collections.deque()
+        self.unexpected = 0     # Number of frames nobody asked for
+    
+    def expect(self,command,wanted=True):
+        '''
+        Note that command was sent and will be answered. Returns the _Request,
+        its frame is filled in when the answer comes in.
+        '''
+        request = _Request(command,wanted)
+        self.pending.append(request)
+        return request
+    
+    def feed(self,data):
+        '''
+        Adds received bytes. Returns the list of _Request that got their 
+        answer, and the list of frames that did not belong to any command.
+        '''
+        frames, self.buffer = self.cut_frames(self.buffer + data)
+        answered = []
+        unexpected = []
+        for frame in frames:
+            if self.pending:
+                request = self.pending.popleft()
+                request.frame = frame
+                answered.append(request)
+            else:
+                self.unexpected = self.unexpected + 1
+                unexpected.append(frame)
+        return answered, unexpected
+    
+    def reset(self):
+        '''
+        Forget everything, for instance after flushing the connection (the 
+        answers we wait for are gone then).
+        '''
+        self.buffer = b''
+        self.pending.clear()
+
+
+class Connection_supervisor():
+    '''
+    Looks after the connection of one controller (every controller has one, as
+    controller.supervisor). It can:
+        * reconnect(): close and reopen the comport, trying again with longer 
+          and longer waits if that fails. This never sends anything to the 
+          device, so the set temperature etc. stay as they are.
+        * check(): ask the device something harmless, to see if it still 
+          answers.
+        * start(): check the connection on a background thread, but only if 
+          nothing was sent for keepalive_interval seconds. This keeps the 
+          connection alive on the Windows XP PCs (instead of julabo.wiggle), 
+          and finds a dead connection before the next step of a ramp does.
+    '''
+    backoff_start = 0.1         # First wait in seconds before trying to reconnect again
+    backoff_max = 10            # Longest wait in seconds between reconnect attempts
+    max_attempts = 10           # Give up after this many failed reconnects
+    
+    def __init__(self,controller,keepalive_interval=60):
+        self.controller = controller
+        self.keepalive_interval = keepalive_interval
+        self.last_activity = time.perf_counter()
+        self.reconnects = 0     # Number of succesfull reconnects, just to know
+        self._thread = None
+        self._stop = threading.Event()
+    
+    def touch(self):
+        '''
+        Note that we just talked to the device.
+        '''
+        self.last_activity = time.perf_counter()
+    
+    def reconnect(self):
+        '''
+        Closes the comport and opens a new connection with the same settings.
+        Raises serial.SerialException if that did not work after max_attempts.
+        '''
+        controller = self.controller
+        wait = self.backoff_start
+        for attempt in range(1,self.max_attempts+1):
+            controller.log.info("Reconnecting to comport %s (attempt %i)", controller.comport, attempt)
+            try:
+                controller.com.close()
+            except Exception:
+                pass # Handle is probably dead anyway
+            try:
+                controller.com = controller._initialize_connection(**controller._connection_settings)
+                controller.opencom()
+                controller.decoder.reset()
+                self.reconnects = self.reconnects + 1
+                self.touch()
+                controller.log.info("Reconnected to comport %s", controller.comport)
+                return
+            except serial.SerialException as e:
+                controller.log.warning("Reconnecting failed: '%s', trying again in %.1f seconds", e, wait)
+                time.sleep(wait)
+                wait = min(2*wait,self.backoff_max)
+        raise serial.SerialException("Could not reconnect to comport %s after %i attempts. Check the cable, or look for Piet." % (controller.comport,self.max_attempts))
+    
+    def check(self):
+        '''
+        Asks the device something that does not change anything. Returns True
+        if it answered properly.
+        '''
+        try:
+            self.controller._keepalive()
+            return True
+        except Exception as e:
+            self.controller.log.warning("Connection check failed: '%s'", e)
+            return False
+    
+    def start(self,keepalive_interval=None):
+        '''
+        Start checking the connection on the background, whenever it was idle
+        for keepalive_interval seconds. If the check fails, we reconnect.
+        '''
+        if keepalive_interval is not None:
+            self.keepalive_interval = keepalive_interval
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,daemon=True,
+                                        name="keepalive %s" % (self.controller.comport,))
+        self._thread.start()
+        self.controller.log.info("Keepalive started, checking connection after %.1f seconds of silence", self.keepalive_interval)
+    
+    def stop(self):
+        '''
+        Stop the background checking.
+        '''
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.controller.log.info("Keepalive stopped")
+    
+    def _run(self):
+        while not self._stop.wait(max(0.01,self.last_activity + self.keepalive_interval - time.perf_counter())):
+            with self.controller._lock.priority(PRIORITY_TELEMETRY), self.controller._lock:
+                if time.perf_counter() - self.last_activity < self.keepalive_interval:
+                    continue # Somebody else talked to the device in the meantime
+                if not self.check():
+                    try:
+                        self.reconnect()
+                    except serial.SerialException as e:
+                        self.controller.log.error(str(e))
+                self.touch()
+
+
+class Temperature_profile():
+    '''
+    A temperature program, made of segments that are run one after the other.
+    You build it by adding segments, and run it with 
+    Temperature_controller.run_profile(). For instance, jump between 30 and 
+    32.5 deg C every hour, 24 times, and then slowly go to 20 deg C:
         
+        p = Temperature_profile(30)         # Start at 30 deg C
+        p.hold(3600).step(32.5,3600)        # 1 hour at 30, 1 hour at 32.5
+        p.repeat(24)                        # Do that 24 times
+        p.ramp(20,7200)                     # Linear to 20 deg C in 2 hours
+        ju.run_profile(p)
+        
+    Any function of time works too: p.function(lambda t: 25+math.sin(t/600),3600)
+    calls the function with the time in seconds since the start of that 
+    segment.
+    When running, a new temperature is only sent to the device when the 
+    profile moved at least 'resolution' (0.01 deg C by default, the resolution 
+    of the devices) since the last one, so slow ramps send few commands.
+    '''
+    def __init__(self,Tstart):
+        self.Tstart = Tstart
+        self.segments = []  # List of (kind, duration, arguments)
+
+    def __repr__(self):
+        return " <Temperature_profile with %i segments, %s long>" % (len(self.segments),str(datetime.timedelta(seconds=self.duration)))
+
+    @property
+    def duration(self):
+        '''
+        Total duration of the profile in seconds.
+        '''
+        return sum(segment[1] for segment in self.segments)
+    
+    @property
+    def Tend(self):
+        '''
+        Temperature at the end of the profile.
+        '''
+        if not self.segments:
+            return self.Tstart
+        return self._segment_value(self.segments[-1],self.segments[-1][1])
+    
+    def ramp(self,T,duration):
+        '''
+        Linear ramp from the current temperature to T in duration seconds.
+        '''
+        self.segments.append( ('ramp',duration,(self.Tend,T)) )
+        return self
+    
+    def hold(self,duration):
+        '''
+        Stay at the current temperature for duration seconds.
+        '''
+        self.segments.append( ('hold',duration,(self.Tend,)) )
+        return self
+    
+    def step(self,T,duration):
+        '''
+        Jump to T and stay there for duration seconds.
+        '''
+        self.segments.append( ('hold',duration,(T,)) )
+        return self
+    
+    def function(self,f,duration,sample_interval=1.0):
+        '''
+        Follow T = f(t) for duration seconds, with t the time in seconds since 
+        the start of this segment. f is checked every sample_interval seconds.
+        '''
+        self.segments.append( ('function',duration,(f,sample_interval)) )
+        return self
+    
+    def repeat(self,n):
+        '''
+        Repeat all segments added so far, so they are done n times in total.
+        '''
+        self.segments = self.segments * n
+        return self
+    
+    def _segment_value(self,segment,t):
+        kind, duration, args = segment
+        if kind == 'ramp':
+            if duration == 0:
+                return args[1]
+            return args[0] + (args[1]-args[0]) * t/duration
+        elif kind == 'hold':
+            return args[0]
+        else:
+            return args[0](t)
+
+    def __call__(self,t):
+        '''
+        Temperature of the profile at t seconds after the start.
+        '''
+        tstart = 0
+        for segment in self.segments:
+            if t <= tstart + segment[1]:
+                return self._segment_value(segment,t-tstart)
+            tstart = tstart + segment[1]
+        return self.Tend
+
+    def setpoints(self,resolution=0.01):
+        '''
+        Returns the list of (time,temperature) at which a new temperature 
+        should be sent to the device. Temperatures are rounded to resolution, 
+        and a new one is only added if it differs from the previous one.
+        '''
+        decimals = max(0,-int(math.floor(math.log10(resolution))))
+        def rounded(T):
+            return round(round(T/resolution)*resolution,decimals)
+        
+        result = [(0.0,rounded(self.Tstart))]
+        def add(t,T):
+            T = rounded(T)
+            if T != result[-1][1]:
+                result.append((t,T))
+        
+        tstart = 0.0
+        for segment in self.segments:
+            kind, duration, args = segment
+            if kind == 'ramp' and duration == 0:
+                add(tstart,args[1])     # A jump, see _segment_value()
+            elif kind == 'ramp':
+                # Send every step of 'resolution' at the moment the ramp gets there
+                n = int(round(abs(args[1]-args[0])/resolution))
+                for k in range(n+1):
+                    t = duration*k/n if n else duration
+                    add(tstart+t, args[0] + (args[1]-args[0])*k/n if n else args[1])
+            elif kind == 'hold':
+                add(tstart,args[0])
+            else:
+                f, sample_interval = args
+                n = int(math.ceil(duration/sample_interval))
+                for k in range(n+1):
+                    t = min(k*sample_interval,duration)
+                    add(tstart+t,f(t))
+            tstart = tstart + duration
+        return result
+
+
+# Fitted Thermal_model of every device, by class and adapter (see 
+# _adapter_keys()), so fit_thermal_model() only has to be done once.
+THERMAL_MODEL_CACHE = os.path.join(os.path.expanduser('~'),'.classywaterbaths_models.json')
+
+class Thermal_model():
+    '''
+    First order model of how the internal temperature T of a device follows 
+    its set temperature:
+        dT/dt = (T_set + offset - T) / tau
+    tau is the time constant in seconds, offset is how far the bath settles 
+    from the set temperature (like the +0.8 deg C of the haakePhoenix). Get 
+    one with Temperature_controller.fit_thermal_model(), or make one yourself
+    with Thermal_model(tau,offset).
+    shape() turns the profile you want the sample to follow into the profile
+    of set temperatures that makes it do so: lead the profile by tau times 
+    its slope, and correct for the offset. For a ramp of 0.01 deg C/min and a
+    tau of 5 minutes, the set temperature runs 0.05 deg C ahead.
+    '''
+    def __init__(self,tau,offset=0.0,residual=None,fitted=None):
+        if tau <= 0:
+            raise ValueError("tau should be positive, not %s" % (tau,))
+        self.tau = tau
+        self.offset = offset
+        self.residual = residual    # RMS error of the fit in deg C/s, None if not fitted
+        self.fitted = fitted        # When it was fitted (ISO format), None if not fitted
+
+    def __repr__(self):
+        return " <Thermal_model tau=%.1f s, offset=%+.2f deg C>" % (self.tau,self.offset)
+
+    @classmethod
+    def fit(cls,history):
+        '''
+        Fits a model to history, a list of (time in seconds, T_internal, 
+        T_set), like the step response of fit_thermal_model(). The T_set of a
+        sample is the set temperature that was in effect since the sample 
+        before it. Every pair of samples gives the slope dT/dt at the average
+        T, and a straight line through slope against (T_set - T) gives 1/tau
+        and offset/tau. Raises ValueError if history can't tell us anything 
+        (no temperature change).
+        '''
+        x = []
+        y = []
+        for (t0,T0,S0),(t1,T1,S1) in zip(history,history[1:]):
+            if t1 <= t0:
+                continue
+            x.append(S1 - (T0+T1)/2)
+            y.append((T1-T0)/(t1-t0))
+        n = len(x)
+        if n < 2:
+            raise ValueError("Need at least 3 samples to fit a thermal model, got %i" % (len(history),))
+        xmean = sum(x)/n
+        ymean = sum(y)/n
+        sxx = sum((xi-xmean)**2 for xi in x)
+        if sxx == 0:
+            raise ValueError("The temperature did not change, can't fit a thermal model")
+        slope = sum((xi-xmean)*(yi-ymean) for xi,yi in zip(x,y))/sxx
+        if slope <= 0:
+            raise ValueError("The temperature does not follow the set temperature, can't fit a thermal model")
+        intercept = ymean - slope*xmean
+        residual = math.sqrt(sum((yi-slope*xi-intercept)**2 for xi,yi in zip(x,y))/n)
+        return cls(1/slope,intercept/slope,residual,datetime.datetime.now().isoformat())
+
+    def predict(self,T,T_set,dt):
+        '''
+        Temperature dt seconds after it was T, if the set temperature stays 
+        T_set.
+        '''
+        return T_set + self.offset + (T - T_set - self.offset)*math.exp(-dt/self.tau)
+
+    def shape(self,profile,sample_interval=None,max_lead=2.0):
+        '''
+        Returns the Temperature_profile of set temperatures that makes the 
+        internal temperature follow profile, if the bath starts settled at 
+        profile(0). sample_interval (seconds) is how often the set temperature
+        is worked out, tau/50 (at least 1 second) if None. The lead is at most
+        max_lead deg C, so a step in profile does not make the bath overshoot 
+        wildly.
+        '''
+        if sample_interval is None:
+            sample_interval = max(1.0,self.tau/50)
+        h = sample_interval/2
+        def setpoint(t):
+            t0 = max(t-h,0)
+            slope = (profile(t+h) - profile(t0))/(t+h-t0)
+            lead = max(-max_lead,min(max_lead,self.tau*slope))
+            return profile(t) + lead - self.offset
+        shaped = Temperature_profile(setpoint(0))
+        shaped.function(setpoint,profile.duration,sample_interval)
+        return shaped
+
+    def to_dict(self):
+        return {'tau' : self.tau, 'offset' : self.offset, 'residual' : self.residual, 'fitted' : self.fitted}
+
+    @classmethod
+    def from_dict(cls,d):
+        return cls(d['tau'],d['offset'],d.get('residual'),d.get('fitted'))
+
+
+class Rolling_statistics():
+    '''
+    Mean, standard deviation and slope (least squares, in deg C per second) 
+    of the readings (t, T) of the last window seconds, see 
+    Temperature_controller.wait_until_stable(). We keep running sums: a new 
+    reading is added to them and readings that fall out of the window are 
+    subtracted, so add() and the statistics take the same time however long
+    the window is.
+    '''
+    def __init__(self,window):
+        self.window = window
+        self.readings = collections.deque()     # (t, T) relative to the first reading, see add()
+        self._t0 = None
+        self._T0 = None
+        self.n = 0
+        self._st = 0.0
+        self._sT = 0.0
+        self._stt = 0.0
+        self._sTT = 0.0
+        self._stT = 0.0
+
+    def add(self,t,T):
+        '''
+        Adds reading T at time t (seconds), and forgets readings that are 
+        more than window seconds older.
+        '''
+        if self._t0 is None:
+            # Relative to the first reading, so the sums stay small and we 
+            # don't lose the digits that matter when subtracting them.
+            self._t0 = t
+            self._T0 = T
+        t = t - self._t0
+        T = T - self._T0
+        self.readings.append((t,T))
+        self._update(t,T,1)
+        while t - self.readings[0][0] > self.window:
+            self._update(*self.readings.popleft(),sign=-1)
+
+    def _update(self,t,T,sign):
+        self.n = self.n + sign
+        self._st = self._st + sign*t
+        self._sT = self._sT + sign*T
+        self._stt = self._stt + sign*t*t
+        self._sTT = self._sTT + sign*T*T
+        self._stT = self._stT + sign*t*T
+
+    @property
+    def span(self):
+        '''
+        Time in seconds between the oldest and newest reading in the window.
+        '''
+        if not self.readings:
+            return 0.0
+        return self.readings[-1][0] - self.readings[0][0]
+
+    @property
+    def mean(self):
+        return self._T0 + self._sT/self.n
+
+    @property
+    def std(self):
+        variance = self._sTT/self.n - (self._sT/self.n)**2
+        return math.sqrt(max(variance,0.0))   # Rounding can make a tiny variance negative
+
+    @property
+    def slope(self):
+        stt = self._stt - self._st**2/self.n
+        if stt <= 0:
+            return 0.0
+        return (self._stT - self._st*self._sT/self.n)/stt
+
+    def settled(self,tolerance,target=None):
+        '''
+        True if the standard deviation and the drift over the window (slope 
+        times window) are at most tolerance deg C, and, if target is not None,
+        the mean is within tolerance of target.
+        '''
+        if self.n < 2:
+            return False
+        if self.std > tolerance or abs(self.slope)*self.window > tolerance:
+            return False
+        return target is None or abs(self.mean-target) <= tolerance
+
+    def summary(self):
+        '''
+        Dict with the mean, std and slope (in deg C per *minute*) of the 
+        window, and the number of readings in it.
+        '''
+        return {'mean'     : self.mean,
+                'std'      : self.std,
+                'slope'    : 60*self.slope,
+                'readings' : self.n}
+
+    def result(self,stable,elapsed,T):
+        '''
+        The dict wait_until_stable() returns: summary() with 'stable', 'time'
+        (elapsed seconds) and 'T' (last reading) added.
+        '''
+        result = self.summary()
+        result.update({'stable' : stable, 'time' : elapsed, 'T' : T})
+        return result
+
+
+# Everything we need to know to talk to a type of device, by protocol name, 
+# see register_protocol(). A class says which one it speaks with its protocol 
+# attribute, see Temperature_controller.__init_subclass__().
+PROTOCOLS = {}
+
+# Options of a protocol that become class attributes of its controller
+_PROTOCOL_ATTRIBUTES = ('terminator','ack_frames','reply_pattern','response_timeout',
+                        'response_time','pipelined_reads','errors','identify_reply')
+
+def register_protocol(name,serial_settings,commands=None,parsers=None,**attributes):
+    '''
+    Describes how to talk to a type of device, and stores it in PROTOCOLS:
+        * serial_settings : dict with the arguments of 
+          Temperature_controller._initialize_connection().
+        * commands : dict of {command name : command}. Commands are encoded 
+          to bytes here, once, instead of every time we send them. Commands 
+          with fields (like 'OUT SP 00 {T:06.2f}\r') are templates, which are
+          filled in by Temperature_controller._command(). Temperature_controller 
+          itself uses 'read_internal', 'read_external', 'read_set', 
+          'set_temperature' (fields T, and centi for the temperature in 0.01 
+          deg C), 'read_pump', 'start_pump' and 'stop_pump', if the protocol 
+          has them.
+        * parsers : dict of {command name : name of the method that turns the
+          reply into a temperature}, for the read_... commands. Those without
+          one get _temperature_parser(), which needs a reply_pattern.
+        * attributes : class attributes of the controller, like terminator, 
+          ack_frames, reply_pattern, response_timeout and pipelined_reads. 
+          identify_reply (a byte regex) is what the device answers to its 
+          'identify' command, discover() only looks for protocols that have it.
+    A device that needs nothing else than this can be used without writing a 
+    class at all, see controller_class().
+    '''
+    unknown = set(attributes) - set(_PROTOCOL_ATTRIBUTES)
+    if unknown:
+        raise ValueError("Unknown protocol options for '%s': %s" % (name,sorted(unknown)))
+    encoded = {}
+    for command_name,command in (commands or {}).items():
+        if isinstance(command,str) and '{' not in command:
+            command = command.encode()
+        encoded[command_name] = command
+    parsers = dict(parsers or {})
+    for command_name in ('read_internal','read_external','read_set'):
+        if command_name in encoded:
+            parsers.setdefault(command_name,'_temperature_parser')
+    for command_name in parsers:
+        if command_name not in encoded:
+            raise ValueError("Protocol '%s' has a parser for unknown command '%s'" % (name,command_name))
+    if attributes.get('identify_reply') is not None:
+        attributes['identify_reply'] = re.compile(attributes['identify_reply'])
+    PROTOCOLS[name] = {'serial'     : dict(serial_settings),
+                       'commands'   : encoded,
+                       'parsers'    : parsers,
+                       'attributes' : attributes}
+    return PROTOCOLS[name]
+
+
+_LAUDA_COMMANDS = {'read_internal'   : "IN PV 00\r",
+                   'read_external'   : "IN PV 01\r",
+                   'read_set'        : "IN SP 00\r",
+                   'set_temperature' : "OUT SP 00 {T:06.2f}\r",
+                   'read_pump'       : "IN MODE 02\r",
+                   'start_pump'      : "START\r",
+                   'stop_pump'       : "STOP\r",
+                   'set_pumppower'   : "OUT SP 01 {power:03}\r",
+                   'read_control'    : "IN MODE 01\r",
+                   'type'            : "TYPE\r",
+                   'version'         : "VERSION\r",
+                   'identify'        : "TYPE\r"}
+
+_LAUDA_PARSERS = {'read_internal' : '_lauda_message_handler',
+                  'read_external' : '_lauda_external_handler',   # -1000 if there is no external sensor
+                  'read_set'      : '_lauda_message_handler'}
+
+_LAUDA_ERRORS = {"ERR_2" : "Wrong input (e.g. buffer overflow)",
+                 "ERR_3" : "Wrong command",
+                 "ERR_5" : "Syntax Error in value",
+                 "ERR_6" : "Illegal Value",
+                 "ERR_8" : "Channel (like external temperature) not available",
+                 "Err_30": "Programmer, all segements occupied"}
+
+register_protocol('LaudaE200',
+                  serial_settings = dict(baudrate = 9600,  # can be set manually in the machine!
+                                         bytesize = serial.EIGHTBITS,
+                                         parity = serial.PARITY_NONE,
+                                         stopbits = serial.STOPBITS_ONE,
+                                         timeout = 15,
+                                         xonxoff = False,
+                                         rtscts = True,    # set to false if it soes not work!
+                                         write_timeout = 15,
+                                         dsrdtr = False,
+                                         inter_byte_timeout = None),
+                  commands = _LAUDA_COMMANDS,
+                  parsers = _LAUDA_PARSERS,
+                  terminator = b'\r\n',
+                  ack_frames = (b'OK',),      # Lauda says OK after every OUT command
+                  reply_pattern = _LAUDA_REPLY,
+                  identify_reply = rb'^\s*R?E ?\d{3}\s*$',   # Ecoline types, like 'E200' or 'RE 206' (a Haake error like 'F001$' is not)
+                  response_timeout = 1.0,
+                  pipelined_reads = True,
+                  errors = _LAUDA_ERRORS)
+
+_HAAKE_COMMANDS = {'read_internal'   : "F1\r",
+                   'read_external'   : "F2\r",
+                   'read_set'        : "R SW\r",
+                   'set_temperature' : "S  {centi:d}\r",
+                   'start_pump'      : "GO\r",
+                   'stop_pump'       : "ST\r",
+                   'read_RTA'        : "R CI\r",
+                   'set_RTA'         : "W CI {c:.2f}\r",
+                   'alarm'           : "AL\r",
+                   'alarm_stop'      : "ER\r",
+                   'identify'        : "R SW\r"}
+
+_HAAKE_PARSERS = {'read_internal' : '_haake_temp_parser',
+                  'read_external' : '_haake_temp_parser',
+                  'read_set'      : '_haake_temp_parser'}
+
+# Everything but the baudrate is the same for both Haakes
+for _name,_baudrate in (('haakeF6',4800),('haakePhoenix',9600)):
+    register_protocol(_name,
+                      serial_settings = dict(baudrate = _baudrate,
+                                             bytesize = serial.EIGHTBITS,
+                                             parity = serial.PARITY_NONE,
+                                             stopbits = serial.STOPBITS_ONE,
+                                             timeout = 5,
+                                             xonxoff = False,
+                                             rtscts = False,
+                                             write_timeout = 5,
+                                             dsrdtr = False,
+                                             inter_byte_timeout = None),
+                      commands = _HAAKE_COMMANDS,
+                      parsers = _HAAKE_PARSERS,
+                      terminator = b'$\r\n',  # Sometimes there is an empty '$\r\n' in front, which is skipped
+                      reply_pattern = _HAAKE_REPLY,
+                      identify_reply = rb'^SW[-+]?\d',   # No version command, but only a Haake says SW+020.00
+                      response_timeout = 1.0,
+                      pipelined_reads = True)
+
+register_protocol('julabo',
+                  serial_settings = dict(baudrate = 4800,
+                                         bytesize = serial.EIGHTBITS,
+                                         parity = serial.PARITY_NONE,
+                                         stopbits = serial.STOPBITS_ONE,
+                                         timeout = 5,
+                                         xonxoff = False,
+                                         rtscts = False,
+                                         write_timeout = 5,
+                                         inter_byte_timeout = None),
+                  commands = {'read_internal'   : "in_pv_00\r",
+                              'read_external'   : "in_pv_02\r",
+                              'read_set'        : "in_sp_00\r",
+                              'set_temperature' : "out_sp_00 {T:06.2f}\r",
+                              'read_pump'       : "in_mode_05\r",
+                              'start_pump'      : "out_mode_05 1\r",
+                              'stop_pump'       : "out_mode_05 0\r",
+                              'identify'        : "version\r"},
+                  parsers = {'read_internal' : '_julabo_temp_parser',
+                             'read_external' : '_julabo_temp_parser',
+                             'read_set'      : '_julabo_temp_parser'},
+                  terminator = b'\n',        # Replies end with '\x8d\n', see _julabo_temp_parser
+                  reply_pattern = _JULABO_REPLY,
+                  identify_reply = rb'JULABO',
+                  pipelined_reads = False,   # Julabo wants a pause between commands
+                  response_timeout = 1.5)    # Slow machine on a slow line (4800 baud)
+
+# The electric controller speaks CompoWay/F: the commands are the part of a
+# frame after node, subaddress and SID, electric wraps them in STX ... ETX BCC.
+register_protocol('electric',
+                  serial_settings = dict(baudrate = 9600,
+                                         bytesize = serial.SEVENBITS,
+                                         parity = serial.PARITY_EVEN,
+                                         stopbits = serial.STOPBITS_TWO,
+                                         timeout = 5,
+                                         xonxoff = False,
+                                         rtscts = False,
+                                         write_timeout = 5,
+                                         inter_byte_timeout = None),
+                  commands = {'write_setpoint' : "0102C40000000001{value:08X}",  # for changing the set point of the first bank, which is what you want
+                              'read_setpoint'  : "0101C40000000001"},
+                  terminator = b'\x03',      # Replies are STX ... ETX BCC, see electric._cut_frames()
+                  identify_reply = rb'^\x02\d\d00000101')   # Reading the set point went fine, see electric._identify_command()
+
+register_protocol('thermo',
+                  serial_settings = dict(baudrate = 9600,
+                                         bytesize = serial.EIGHTBITS,
+                                         parity = serial.PARITY_NONE,
+                                         stopbits = serial.STOPBITS_ONE),
+                  commands = {'read_set' : "RS\r"})
+
+
+def controller_class(protocol):
+    '''
+    Returns the class that controls a device speaking protocol (a name in 
+    PROTOCOLS), like julabo for 'julabo'. If there is no such class, one is 
+    made from the table alone, so a new bath that talks like the others only 
+    needs register_protocol():
+        register_protocol('mybath', serial_settings=..., commands=..., ...)
+        mb = controller_class('mybath')('com5')
+    '''
+    if protocol not in PROTOCOLS:
+        raise ValueError("Unknown protocol '%s', choose from %s" % (protocol,sorted(PROTOCOLS)))
+    if protocol not in _controller_classes:
+        def __init__(self,comport,lazy=False):
+            Temperature_controller.__init__(self,comport,lazy)
+            self.log.info("You selected a device speaking protocol '%s'", protocol)
+            self._connect()
+        type(protocol,(Temperature_controller,),{'protocol' : protocol,
+                                                 '__init__' : __init__,
+                                                 '__doc__'  : "Controller made from PROTOCOLS['%s']." % (protocol,)})
+    return _controller_classes[protocol]
+
+# Class for every protocol, filled in by Temperature_controller.__init_subclass__()
+_controller_classes = {}
+
 
 class Temperature_controller():
     '''
@@ -84,8 +1105,77 @@ class Temperature_controller():
     that all classes do, so for instance the ramping function.
     This Class has great power, use with great responsibility.
     '''
-    def __init__(self,comport):
+    # How replies of the device look, used by FrameDecoder. Children that know
+    # their protocol set the terminator (the bytes every reply ends with), so 
+    # we can stop reading as soon as the reply is complete, and know which 
+    # reply belongs to which command. If we don't know the terminator, we fall
+    # back to waiting response_time, reading whatever has arrived and flushing
+    # the connection after every command (see _read_response()).
+    terminator = None
+    ack_frames = ()             # Frames that are acknowledgements, not replies to a question
+    response_timeout = 1.0      # Max time in seconds we wait for a complete reply
+    response_time = 0.1         # Fixed wait in seconds if terminator is unknown
+    poll_interval = 0.002       # Time in seconds between checks for incoming bytes
+    pipelined_reads = False     # True if the device can handle several questions sent in one go, see read_all()
+    reply_pattern = None        # Regular expression for one reply, see _parse_replies()
+    identify_reply = None       # Regular expression for the answer to 'identify', see _identify()
+    _wiretrace = None           # Where raw bytes are recorded, see enable_wiretrace()
+    # How changet() checks that the set temperature arrived. We read back the 
+    # set temperature after confirm_poll seconds, and keep doubling the wait
+    # (up to confirm_poll_max) until it matches or confirm_timeout has passed.
+    confirm_poll = 0.02
+    confirm_poll_max = 0.5
+    confirm_timeout = 3.0
+    # Default max_age (in seconds) of read_internal() etc., see _cached(). 0 
+    # means always ask the device.
+    cache_max_age = 0
+    # Name of the protocol in PROTOCOLS this device speaks. Its serial 
+    # settings, commands, parsers and class attributes are copied to the class
+    # when it is made, see __init_subclass__().
+    protocol = None
+    _serial_settings = None
+    _commands = {}
+    _parsers = {}
+    
+    def __init_subclass__(cls,**kwargs):
+        '''
+        Gives a class with a protocol the serial settings, (pre-encoded) 
+        commands, parsers and class attributes of PROTOCOLS[cls.protocol].
+        '''
+        super().__init_subclass__(**kwargs)
+        if cls.__dict__.get('protocol') is None:
+            return
+        description = PROTOCOLS[cls.protocol]
+        cls._serial_settings = description['serial']
+        cls._commands = description['commands']
+        cls._parsers = description['parsers']
+        for name,value in description['attributes'].items():
+            setattr(cls,name,value)
+        _controller_classes.setdefault(cls.protocol,cls)
+    
+    def __init__(self,comport,lazy=False):
         self.comport = comport
+        # With lazy, the comport is only opened for the first command, see 
+        # _connect(). Until then self.com is None.
+        self.lazy = lazy
+        self.com = None
+        # Every device has its own logger, like 'classywaterbaths.julabo.com4',
+        # so you can turn on debugging for only one of them. Give the arguments 
+        # to the logger seperately (not with %), then the message is only 
+        # made if it is actually logged.
+        self.log = logging.getLogger('classywaterbaths.%s.%s' % (self.__class__.__name__,
+                                                                 str(comport).replace('.','_')))
+        # Only one thread at a time may talk to the device, otherwise questions
+        # and answers get mixed up. Shared by all controllers on this comport.
+        self._lock = port_queue(comport)
+        self.supervisor = Connection_supervisor(self)
+        self.decoder = FrameDecoder(self._cut_frames)
+        self._latest = None             # Newest sample of start_acquisition()
+        self._acquisition = None
+        self._acquisition_stop = threading.Event()
+        # Last value of every reading, with the time we got it, see _cached()
+        self._readings = {}
+        self.thermal_model = None       # See fit_thermal_model()
 
     def __repr__(self):
         message = " <%s object controlling comport %s>" % (str(self.__class__),
@@ -96,7 +1186,8 @@ class Temperature_controller():
         '''
         This is returned if you do print(Temperature_controller)
         '''
-        message = "Connection to Temperature_controller at comport:\t%s\nInternal temperature is currently:\t%.2f\nSet temperature is currently:\t%.2f\n" % (self.comport,self._readtemp_internal(),self._readtemp_set())
+        temperatures = self.read_all(max_age=1) # Printing twice in a row should not ask twice
+        message = "Connection to Temperature_controller at comport:\t%s\nInternal temperature is currently:\t%.2f\nSet temperature is currently:\t%.2f\n" % (self.comport,temperatures['T_internal'],temperatures['T_set'])
         return message
     
     def _initialize_connection(self,
@@ -113,10 +1204,27 @@ class Temperature_controller():
         '''
         Does what you think it does. It makes a connection to the waterbath with
         given parameters.
-        '''
-        logging.info('Initializing connection...')
+        If the comport looks like an URL (like 'socket://...' or the 'sim://...'
+        of waterbath_simulator.py), pyserial's URL handlers are used.
+        '''
+        self.log.debug('Initializing connection...')
+        # Remember settings, so the supervisor can reconnect
+        self._connection_settings = dict(baudrate = baudrate,
+                                         bytesize = bytesize,
+                                         parity = parity,
+                                         stopbits = stopbits,
+                                         timeout = timeout,
+                                         xonxoff = xonxoff,
+                                         rtscts = rtscts,
+                                         write_timeout = write_timeout,
+                                         dsrdtr = dsrdtr,
+                                         inter_byte_timeout = inter_byte_timeout)
+        if '://' in self.comport:
+            open_port = serial.serial_for_url
+        else:
+            open_port = serial.Serial
         try: 
-            connection = serial.Serial(
+            connection = open_port(
                 self.comport,
                 baudrate = baudrate,
                 bytesize = bytesize,
@@ -129,10 +1237,10 @@ class Temperature_controller():
                 dsrdtr = dsrdtr,
                 inter_byte_timeout = inter_byte_timeout,
                 )
-            logging.info('Connected to device at comport %s' % self.comport)
+            self.log.info('Connected to device at comport %s', self.comport)
             return connection
         except serial.SerialException:
-            logging.exception("Selected comport not found or wrong permissions.")
+            self.log.exception("Selected comport not found or wrong permissions.")
             raise serial.SerialException("Wrong comport, find the correct "
                                         "comport using"
                                         "'find_available_comports(True)'. If "
@@ -140,102 +1248,541 @@ class Temperature_controller():
                                         "you have permission to open COMports."
                                         " Or look for Piet.")
         
+    def _connect(self):
+        '''
+        Opens the connection with the serial settings of our protocol, and 
+        checks it with _handshake(). If we were made with lazy=True, this 
+        waits for the first command instead (see _ensure_connected()), so 
+        making a controller costs nothing until we use it.
+        '''
+        if self.lazy:
+            self.log.debug("Connecting to comport %s on the first command", self.comport)
+            return
+        self.com = self._initialize_connection(**self._serial_settings)
+        self.opencom()
+        self._handshake()
+        
+    def _ensure_connected(self):
+        '''
+        Opens the connection if that was put off by lazy, see _connect().
+        '''
+        if self.com is None:
+            with self._lock:
+                if self.com is None:
+                    self.lazy = False
+                    self._connect()
+        
+    def _handshake(self):
+        '''
+        Checks a new connection, by asking something (never setting 
+        anything!), and raises serial.SerialException if it is not right. 
+        Most devices don't need it: the first real command will tell.
+        '''
+        pass
+        
+    def _command(self,name,**fields):
+        '''
+        Returns command name of our protocol as bytes, with the fields of a 
+        template (like T for 'OUT SP 00 {T:06.2f}\r') filled in.
+        '''
+        command = self._commands[name]
+        if isinstance(command,str):
+            command = command.format(**fields).encode()
+        return command
+        
+    def _identify_command(self):
+        '''
+        Bytes to send to find out if the device speaks our protocol.
+        '''
+        return self._commands.get('identify')
+        
+    def _identify(self,timeout):
+        '''
+        True if the device answers the identify command of our protocol with 
+        identify_reply within timeout seconds. Used by discover(), so this 
+        talks to the port directly: no reconnecting, and no warnings if 
+        nothing comes back, which is the normal answer of another device.
+        '''
+        command = self._identify_command()
+        if command is None or self.identify_reply is None or self.terminator is None:
+            return False
+        request = self.decoder.expect(command)
+        self.com.write(command)
+        deadline = time.perf_counter() + timeout
+        while request.frame is None and time.perf_counter() < deadline:
+            readlength = self.com.inWaiting()
+            if readlength:
+                self.decoder.feed(self.com.read(readlength))
+            else:
+                time.sleep(self.poll_interval)
+        if request.frame is None:
+            return False
+        # translate: the Julabo sets the parity bit itself
+        return self.identify_reply.search(bytes(request.frame).translate(_STRIP_PARITY)) is not None
+        
     def closecom(self):
         '''
         Close port if comport is open.
         '''
-        if self.com.isOpen(): 
-            logging.debug('Closing comport...')
+        if self.com is not None and self.com.isOpen(): 
+            self.log.debug('Closing comport...')
             self.com.close()
-            logging.debug('Comport is now closed')
+            self.log.debug('Comport is now closed')
             
     def opencom(self):
         '''
-        Open port if comport is closed.
+        Open port if comport is closed (or was never opened, see lazy).
         '''
-        if not self.com.isOpen():
-            logging.debug("Opening comport...")
+        if self.com is None:
+            self._ensure_connected()
+        elif not self.com.isOpen():
+            self.log.debug("Opening comport...")
             self.com.open()
-            logging.debug("Comport is now open")
+            self.decoder.reset()
+            self.log.debug("Comport is now open")
             
-    def _out_command(self,command,flush=True):
+    def enable_wiretrace(self,filename=None):
+        '''
+        Records every byte that goes over the line, with the time. Usefull for
+        debugging a device that does weird stuff.
+        If filename is None, records are kept in self.wiretrace as a list of 
+        (time, direction, bytes), with direction '>' to and '<' from the device. 
+        Otherwise they are added to the (binary) file, read it back with 
+        read_wiretrace(filename).
+        '''
+        if filename is None:
+            self.wiretrace = []
+            self._wiretrace = self.wiretrace.append
+        else:
+            f = open(filename,'ab')
+            def write(record):
+                t, direction, data = record
+                f.write(_WIRETRACE_HEADER.pack(t,direction.encode(),len(data)) + data)
+                f.flush()
+            write.file = f
+            self._wiretrace = write
+        self.log.info("Wiretrace enabled (%s)", filename or 'in memory')
+    
+    def disable_wiretrace(self):
         '''
-        Setting values of parameters. Does not return anything. Fot instance, 
-        can set the temperature.
+        Stops recording bytes, see enable_wiretrace().
+        '''
+        if hasattr(self._wiretrace,'file'):
+            self._wiretrace.file.close()
+        self._wiretrace = None
+        self.log.info("Wiretrace disabled")
+        
+    def _out_command(self,command,flush=True,wanted=False):
+        '''
+        Setting values of parameters. Fot instance, can set the temperature.
+        If the device answers this command (see _expects_reply()), the answer 
+        is registered with the FrameDecoder and the _Request is returned 
+        (wanted=True if you are going to wait for it, see _await_replies()). 
+        Otherwise, returns None. If we don't know the terminator, the 
+        connection is flushed (if flush is True) instead, to get rid of the 
+        answer.
         
         Has error catching mechanism --> sometimes "SerialException: WriteFile 
         failed (PermissionError(13, 'The device does not recognize the command.',
         None, 22))" is thrown after long stretch of inactivity. Manually, you 
         can solve this by just restarting 'ju = julabo('com4')' etc.. 
         This is an attempt to do this automatically, so a ramp or something will
-        not be disturbed.
+        not be disturbed. The supervisor only reopens the comport, it does not
+        send anything else to the device (not even the _handshake()).
+        '''
+        if not isinstance(command,bytes): # electric already gives bytes
+            command = command.encode()
+        with self._lock:
+            self._write(command)
+            if self.terminator is None:
+                if flush:
+                    self._flush() # To remove command from buffer
+                return None
+            if self._expects_reply(command):
+                return self.decoder.expect(command,wanted)
+            return None
+    
+    def _write(self,command):
         '''
-        logging.debug("Trying to write command to device: '%s'" %str(command) )
-        try:
-            self.com.write( command.encode() )
-            logging.debug("Command transfered to device succesfully")
-        except serial.SerialException:
-            logging.exception("Command transfer to device failed.")
-            print("I detected that the connection to the device has been "
-                "interupted. I will try to reset the connection. This may fail!")
-            logging.info("Re-initializing connection after detecting broken connection")
-            print(">>> REINITIALISING CONNECTION <<<")
-            self.__init__(self.comport)
-            self.com.write( command.encode() )
-            logging.debug("Command transfered to device succesfully")
-            print(">>>REINITIALISATION SUCCESFULL<<<")
-        if flush:
-            self._flush() # To remove command from buffer
+        Writes command (bytes) to the device, reconnects if the connection is 
+        broken, see _out_command().
+        '''
+        self.log.debug("Trying to write command to device: '%s'", command)
+        with self._lock:
+            self._ensure_connected()
+            try:
+                self.com.write( command )
+                if self._wiretrace is not None:
+                    self._wiretrace( (time.time(),'>',command) )
+                self.log.debug("Command transfered to device succesfully")
+            except serial.SerialException:
+                self.log.exception("Command transfer to device failed.")
+                print("I detected that the connection to the device has been "
+                    "interupted. I will try to reset the connection. This may fail!")
+                self.log.info("Reconnecting after detecting broken connection")
+                print(">>> RECONNECTING <<<")
+                self.supervisor.reconnect()
+                self.com.write( command )
+                if self._wiretrace is not None:
+                    self._wiretrace( (time.time(),'>',command) )
+                self.log.debug("Command transfered to device succesfully")
+                print(">>>RECONNECTING SUCCESFULL<<<")
+            self.supervisor.touch()
+    
+    def _expects_reply(self,command):
+        '''
+        True if the device answers command (bytes). Most devices answer 
+        everything, if only with an acknowledgement.
+        '''
+        return True
         
-    def _in_command(self,command):
+    def _in_command(self,command,timeout=None):
         '''
         Asking for parameters or temperatures to be returned by waterbath. 
-        Returns raw message.
+        Returns raw reply (one frame), or b'' if it did not come in time. 
+        timeout is the max time in seconds to wait for the reply, if None, use 
+        response_timeout of the class.
+        '''
+        self.log.debug("Trying to write command to device: '%s'", command)
+        with self._lock:
+            request = self._out_command(command,False,wanted=True) # use _out_command to send message
+            if request is None: # We don't know how replies look
+                message = self._read_response(timeout)
+                self._flush() # to remove command(and answer) from buffer
+            else:
+                self._await_replies([request],timeout)
+                message = request.frame or b''
+            self.log.debug("Response received: '%s'", message)
+        return message
+    
+    def _in_commands(self,commands,timeout=None):
+        '''
+        Sends a couple of questions in one go, and returns the list of replies
+        (one frame per question, in the same order, if all went well; replies 
+        that did not come in time are left out). Only use this for devices 
+        that have pipelined_reads = True, or that answer every command (like 
+        electric). timeout is for all replies together, if None, use 
+        response_timeout for every command.
+        '''
+        if timeout is None:
+            timeout = self.response_timeout * len(commands)
+        with self._lock:
+            # One write, but every command gets its own place in the queue
+            commands = [command if isinstance(command,bytes) else command.encode() for command in commands]
+            self._write(b''.join(commands))
+            requests = [self.decoder.expect(command) for command in commands]
+            self._await_replies(requests,timeout)
+        frames = [request.frame for request in requests if request.frame is not None]
+        self.log.debug("Responses received: '%s'", frames)
+        return frames
+    
+    def _await_replies(self,requests,timeout=None):
+        '''
+        Reads from the device until all requests have their reply, or timeout 
+        seconds have passed. Replies to other commands (acknowledgements) are 
+        checked on the way. If the replies don't come in time, we give up on 
+        everything that is still underway: the decoder is reset and the 
+        connection flushed, so late replies can't be mixed up with the next 
+        ones.
+        '''
+        if timeout is None:
+            timeout = self.response_timeout
+        deadline = time.perf_counter() + timeout
+        while any(request.frame is None for request in requests):
+            readlength = self.com.inWaiting()
+            if readlength:
+                data = self.com.read(readlength)
+                if self._wiretrace is not None:
+                    self._wiretrace( (time.time(),'<',data) )
+                answered, unexpected = self.decoder.feed(data)
+                for request in answered:
+                    if not request.wanted and not self._is_ack(request.frame):
+                        self.log.warning("Device answered '%s' to command '%s'", request.frame, request.command)
+                for frame in unexpected:
+                    self.log.warning("Received '%s' without asking for it", frame)
+                if all(request.frame is not None for request in requests):
+                    return
+            # Also when data keeps coming in, noise on the line should not 
+            # keep us (and the lock) here forever
+            if time.perf_counter() > deadline:
+                self.log.warning("No complete response within %.2f seconds, received: '%s'", timeout, self.decoder.buffer)
+                self._flush()
+                return
+            if not readlength:
+                time.sleep(self.poll_interval)
+
+    def _read_all_queries(self):
+        '''
+        For devices with pipelined_reads: returns a list of (name, command,
+        parser) for the internal, external and set temperature, used by 
+        read_all(). parser turns the reply into a temperature. Made from the
+        read_... commands and parsers of our protocol, None if it does not 
+        have all three (then we ask one by one).
+        '''
+        queries = (('T_internal','read_internal'),('T_external','read_external'),('T_set','read_set'))
+        if not all(command in self._parsers for _,command in queries):
+            return None
+        return [(name, self._commands[command], getattr(self,self._parsers[command])) for name,command in queries]
+    
+    def read_all(self,max_age=None):
+        '''
+        Reads internal, external and set temperature, returns them in a dict 
+        with keys 'T_internal', 'T_external' and 'T_set'. If the device 
+        allows it (pipelined_reads), all questions are sent in one go, which 
+        is a lot faster than asking one by one. If that fails, or the device
+        does not allow it, we just ask one by one.
+        If all three were read less than max_age seconds ago, we don't ask the
+        device at all, see _cached().
+        '''
+        names = ('T_internal','T_external','T_set')
+        fresh = [self._fresh(name,max_age) for name in names]
+        if None not in fresh:
+            return dict(zip(names,fresh))
+        temperatures = self._read_all()
+        for name in names:
+            self._remember(name,temperatures[name])
+        return temperatures
+    
+    def _read_all(self):
+        queries = self._read_all_queries() if self.pipelined_reads else None
+        if queries is not None:
+            frames = self._in_commands([command for _,command,_ in queries])
+            if len(frames) == len(queries):
+                return dict( (name,parser(frame)) for (name,_,parser),frame in zip(queries,frames) )
+            self.log.warning("Got %i replies to %i questions, reading one by one instead", len(frames), len(queries))
+        return {'T_internal' : self._readtemp_internal(),
+                'T_external' : self._readtemp_external(),
+                'T_set'      : self._readtemp_set()}
+    
+    def read_internal(self,max_age=None):
         '''
-        logging.debug("Trying to write command to device: '%s'" %str(command) )
-        self._out_command(command,False) # use _out_command to send message
-        time.sleep(0.1)
-        readlength=self.com.inWaiting()
-        message = self.com.read(readlength)
-        logging.debug("Response received: '%s'" %str(message) )
-        self._flush() # to remove command(and answer) from buffer
+        Returns the internal temperature. If we read it less than max_age 
+        seconds ago (default: cache_max_age), that reading is returned without
+        asking the device.
+        '''
+        return self._cached('T_internal',self._readtemp_internal,max_age)
+    
+    def read_external(self,max_age=None):
+        '''
+        Returns the external temperature, see read_internal() for max_age.
+        '''
+        return self._cached('T_external',self._readtemp_external,max_age)
+    
+    def read_set(self,max_age=None):
+        '''
+        Returns the set temperature, see read_internal() for max_age. After 
+        changet() the new set temperature is known without asking.
+        '''
+        return self._cached('T_set',self._readtemp_set,max_age)
+    
+    def read_pump(self,max_age=None):
+        '''
+        Returns True if the pump is running, False if not, and None if the 
+        device can't tell us. See read_internal() for max_age. After 
+        start_pump() and stop_pump() this is known without asking.
+        '''
+        return self._cached('pump',self._readpump,max_age)
+    
+    def _cached(self,name,reader,max_age=None):
+        '''
+        Returns the last reading of name if it is at most max_age seconds old,
+        otherwise calls reader() to ask the device and remembers the answer.
+        With max_age None, cache_max_age is used. With max_age 0, we always ask.
+        '''
+        value = self._fresh(name,max_age)
+        if value is None:
+            value = reader()
+            self._remember(name,value)
+        return value
+    
+    def _fresh(self,name,max_age=None):
+        '''
+        Returns the last reading of name if it is at most max_age seconds old,
+        otherwise None.
+        '''
+        if max_age is None:
+            max_age = self.cache_max_age
+        reading = self._readings.get(name)
+        if max_age > 0 and reading is not None and time.perf_counter() - reading[1] <= max_age:
+            return reading[0]
+        return None
+    
+    def _remember(self,name,value):
+        '''
+        Stores a reading in the cache. A value of None forgets it.
+        '''
+        if value is None:
+            self._readings.pop(name,None)
+        else:
+            self._readings[name] = (value,time.perf_counter())
+    
+    def _read_response(self,timeout=None):
+        '''
+        Reads the reply of a device of which we don't know the terminator: 
+        just wait self.response_time and read what is there. Devices that have 
+        a terminator use _await_replies() instead.
+        '''
+        time.sleep(self.response_time)
+        message = self.com.read(self.com.inWaiting())
+        if self._wiretrace is not None:
+            self._wiretrace( (time.time(),'<',message) )
         return message
     
+    def _cut_frames(self,message):
+        '''
+        Cuts raw message into complete replies (including terminator), and 
+        returns those together with the incomplete rest.
+        '''
+        frames = []
+        n = len(self.terminator)
+        start = 0
+        end = message.find(self.terminator)
+        while end != -1:
+            frames.append(message[start:end+n])
+            start = end + n
+            end = message.find(self.terminator,start)
+        return frames, message[start:]
+    
+    def _is_ack(self,frame):
+        '''
+        True if frame is an acknowledgement (empty, or one of ack_frames) 
+        instead of a real answer.
+        '''
+        body = frame[:-len(self.terminator)].strip()
+        return not body or body in self.ack_frames
+    
+    def _parse_replies(self,message):
+        '''
+        Cuts message (bytes, bytearray or memoryview, may hold any number of 
+        replies) into replies with reply_pattern, and returns them as a list of
+        Reply (value, status, error). Incomplete replies at the end are left 
+        out, empty replies (bare terminators) too.
+        '''
+        replies = []
+        for match in self.reply_pattern.finditer(message):
+            kind = match.lastgroup
+            if kind == 'value':
+                replies.append( Reply(float(match.group('value')),'value',None) )
+            elif kind == 'ack':
+                replies.append( Reply(None,'ack',None) )
+            elif kind == 'no_sensor':
+                replies.append( Reply(None,'no_sensor',None) )
+            elif kind == 'error':
+                replies.append( Reply(None,'error',match.group('error').decode('ascii')) )
+            elif match.group('other'):
+                replies.append( Reply(None,'error',match.group('other').decode('ascii','replace')) )
+        return replies
+    
+    def _temperature_parser(self,message):
+        '''
+        Returns the last temperature in message. Used for the read_... 
+        commands of protocols that don't name a parser, see 
+        register_protocol().
+        '''
+        for reply in reversed(self._parse_replies(message)):
+            if reply.status == 'value':
+                return reply.value
+        raise ValueError("Parser could not read %s response: '%s'" % (self.__class__.__name__,message))
+    
+    def _keepalive(self):
+        '''
+        Something harmless to ask the device, to check if the connection is 
+        still alive. Should raise an error if the device does not answer.
+        '''
+        self._readtemp_set()
+    
+    def start_keepalive(self,keepalive_interval=60):
+        '''
+        Checks the connection on the background if nothing was sent for 
+        keepalive_interval seconds, and reconnects if it is broken. See 
+        Connection_supervisor.
+        '''
+        self.supervisor.start(keepalive_interval)
+    
+    def stop_keepalive(self):
+        self.supervisor.stop()
+    
     def _flush(self):
         '''
         Flush the connection.
         '''
-        logging.debug("Flushing connection")
-        self.com.flushInput()
-        self.com.flushOutput()
+        self.log.debug("Flushing connection")
+        if self.com is not None:
+            self.com.flushInput()
+            self.com.flushOutput()
+        self.decoder.reset() # Replies we were waiting for are gone now
         
+    def _query(self,name,description):
+        '''
+        Sends command name of our protocol, and returns the reply parsed by 
+        the parser of that command. Returns 0 if the protocol does not have 
+        the command, just to avoid errors in printing incomplete classes!
+        '''
+        if name not in self._parsers:
+            return 0
+        self.log.debug("Reading %s", description)
+        message = self._in_command(self._commands[name])
+        self.log.debug("Raw %s reading is: '%s'", description, message)
+        return getattr(self,self._parsers[name])(message)
+    
     def _readtemp_internal(self):
         '''
-        This function is made to be overridden in one of the child classes. 
-        Just to avoid errors in printing incomplete classes!
+        Reads out internal temperature.
         '''
-        return 0
+        return self._query('read_internal','internal temperature')
     
     def _readtemp_external(self):
         '''
-        This function is made to be overridden in one of the child classes. 
-        Just to avoid errors in printing incomplete classes!
+        Reads out external temperature. Usefull if we add sensor to setup 
+        (which we won't do, but you know...).
         '''
-        return 0
+        return self._query('read_external','external temperature')
     
     def _readtemp_set(self):
         '''
-        This function is made to be overridden in one of the child classes. 
-        Just to avoid errors in printing incomplete classes!
+        Reads out set temperature.
         '''
-        return 0
+        return self._query('read_set','set temperature')
     
     def _set_temperature(self,T):
         '''
-        This function is made to be overridden in one of the child classes. 
-        Just to avoid errors in printing incomplete classes!
+        Changes set temperature of the device. DO NOT USE DIRECTLY, USE 
+        changet() INSTEAD! Does nothing if our protocol can't set the 
+        temperature.
         '''
-        pass
+        if 'set_temperature' not in self._commands:
+            return
+        self.log.debug("Changing set temperature to '%s'", T)
+        self._out_command( self._command('set_temperature',T=float(T),centi=round(float(T)*100)) )
+        self.log.debug("Set temperature was changed")
+    
+    def _readpump(self):
+        '''
+        Returns True if the pump is running. Override in the child classes that 
+        can tell, None means we don't know.
+        '''
+        return None
+    
+    def start_pump(self):
+        '''
+        Starts the pump and heating/cooling elements of this device.
+        '''
+        if 'start_pump' not in self._commands:
+            raise NotImplementedError("%s can't start the pump" % (self.__class__.__name__,))
+        self.log.info("Starting pump and heating/cooling")
+        self._out_command( self._commands['start_pump'] )
+        self._remember('pump',True)
+        
+    @_with_priority(PRIORITY_SAFETY)
+    def stop_pump(self):
+        '''
+        Stops the pump and heating/cooling elements of this device.
+        '''
+        if 'stop_pump' not in self._commands:
+            raise NotImplementedError("%s can't stop the pump" % (self.__class__.__name__,))
+        self.log.info("Stopping pump and heating/cooling")
+        self._out_command( self._commands['stop_pump'] )
+        self._remember('pump',False)
     
     def passive_logging(self,time_interval = 15, verbose = False):
         '''
@@ -245,16 +1792,16 @@ class Temperature_controller():
         Minimum is quite low, 5 seconds is easily enough.
         set verbose to True to also print the found values (as opposed to 
         just logging them)
+        This blocks the console, use start_acquisition() to log on the 
+        background while you keep giving commands.
         '''
         print("Starting passive logging: I will note the temperatures every %f seconds. This will last indefinitly unless you kill me. To kill me, press crtl+c." % (time_interval,) )
-        logging.debug("Start passive logging")
+        self.log.debug("Start passive logging")
         while True:
             ti = time.perf_counter()
-            Ti = self._readtemp_internal()
-            Te = self._readtemp_external()
-            Ts = self._readtemp_set()
-            tolog = "T_internal = %s, T_external = %s, T_set = %s" % (str(Ti),str(Te),str(Ts)) 
-            logging.info(tolog)
+            temperatures = self.read_all()
+            tolog = "T_internal = %s, T_external = %s, T_set = %s" % (str(temperatures['T_internal']),str(temperatures['T_external']),str(temperatures['T_set'])) 
+            self.log.info(tolog)
             if verbose:
                 print(tolog)
                 
@@ -263,17 +1810,85 @@ class Temperature_controller():
             tcorrection = tf-ti
             slptime = math.floor(time_interval-tcorrection)
             if slptime <0:
-                logging.error("passive_logging time_interval chosen too short")
+                self.log.error("passive_logging time_interval chosen too short")
                 raise ValueError("time_interval too short! Passive logging impossible.")
             for _ in range(slptime):
                 time.sleep(1)
             time.sleep(time_interval-tcorrection-slptime)
-            
-        
+    
+    def start_acquisition(self,time_interval=15,verbose=False):
+        '''
+        Like passive_logging(), but on the background, so you can keep using 
+        the console (and changet(), ramp() etc.) in the meantime. Every 
+        time_interval seconds the temperatures are read, logged, and stored in
+        self.latest. Commands from the console wait at most for one reading, 
+        they share the comport through the lock of the controller.
+        Stop with stop_acquisition().
+        '''
+        if self._acquisition is not None and self._acquisition.is_alive():
+            raise RuntimeError("Acquisition is allready running, use stop_acquisition() first")
+        self._acquisition_stop.clear()
+        self._acquisition = threading.Thread(target=self._acquire,args=(time_interval,verbose),daemon=True,
+                                             name="acquisition %s" % (self.comport,))
+        self._acquisition.start()
+        self.log.info("Started acquisition every %.1f seconds", time_interval)
+    
+    def stop_acquisition(self):
+        '''
+        Stops start_acquisition(). self.latest keeps the last sample.
+        '''
+        self._acquisition_stop.set()
+        if self._acquisition is not None:
+            self._acquisition.join()
+            self._acquisition = None
+        self.log.info("Stopped acquisition")
+    
+    def priority(self,priority):
+        '''
+        Use as 'with ju.priority(PRIORITY_TELEMETRY):', everything you send to 
+        the device in the with-block (from this thread) goes with that 
+        priority. See Port_queue.
+        '''
+        return self._lock.priority(priority)
+    
+    @property
+    def latest(self):
+        '''
+        Newest sample of start_acquisition(): dict with 'time' (time.time()),
+        'T_internal', 'T_external' and 'T_set', or None if there is none yet. 
+        Never waits for the device.
+        '''
+        return self._latest
+    
+    def _acquire(self,time_interval,verbose):
+        tnext = time.perf_counter()
+        while not self._acquisition_stop.is_set():
+            try:
+                with self.priority(PRIORITY_TELEMETRY):
+                    temperatures = self.read_all()
+            except Exception as e:
+                self.log.warning("Acquisition reading failed: '%s'", e)
+            else:
+                temperatures['time'] = time.time()
+                # A new dict every time, so whoever reads latest never sees a
+                # half updated sample.
+                self._latest = temperatures
+                self.log.info("T_internal = %s, T_external = %s, T_set = %s", temperatures['T_internal'], temperatures['T_external'], temperatures['T_set'])
+                if verbose:
+                    print("T_internal = %s, T_external = %s, T_set = %s" % (temperatures['T_internal'],temperatures['T_external'],temperatures['T_set']))
+            tnext = tnext + time_interval
+            if tnext < time.perf_counter():
+                self.log.warning("Acquisition is behind schedule, time_interval is too short")
+                tnext = time.perf_counter()
+            self._acquisition_stop.wait(tnext - time.perf_counter())
         
-    def ramp(self,Tinit,Tend,dT,totaltime,ask=True,verbose=False):
+    def ramp(self,Tinit,Tend,dT,totaltime,ask=True,verbose=False,late='catchup',feedforward=False):
         '''
         Makes a block temperature ramp with device for controlling temperature.
+        Every step k is planned at exactly k*totaltime/steps after the start, so
+        time spent changing the temperature does not add up over the ramp. 
+        After the ramp, self.last_ramp contains the planned and actual time of
+        every step.
 
         IN:
             * Tinit     : Start temperature of ramp in deg C.
@@ -284,85 +1899,170 @@ class Temperature_controller():
                           wait for user conformation. If False, it will just 
                           start.
             * verbose   : Boolean, set to True to get all debug info.
+            * late      : What to do if we are behind schedule (because 
+                          changet() took longer than the time between steps).
+                          'catchup' sends the steps we missed right away, 
+                          'skip' skips them and goes on with the step that is
+                          due now.
+            * feedforward : Boolean, if True, the *internal* temperature 
+                          follows a straight line from Tinit to Tend, instead
+                          of the set temperature making steps. The set 
+                          temperature is shaped with the Thermal_model of the
+                          device (see fit_thermal_model()), in steps of dT. 
+                          The bath should be settled at Tinit before you 
+                          start.
         '''
-        logging.info("You selected a ramp: Tinit=%f, Tend=%f, dT=%f, totaltime=%f" %(Tinit,Tend,dT,totaltime))
+        self.log.info("You selected a ramp: Tinit=%f, Tend=%f, dT=%f, totaltime=%f", Tinit, Tend, dT, totaltime)
+        if late not in ('catchup','skip'):
+            raise ValueError("late should be 'catchup' or 'skip', not '%s'" % (late,))
         t00 = time.perf_counter()                                             # Initialize internal clock (in seconds)
-        steps = abs(round((Tend-Tinit)/dT))                       # Number of steps
-        if Tinit > Tend: # Ramp down
-            Trange = [round(Tinit - i*dT,2) for i in range(0,steps+1)] # Temperatures we will visit
-        elif Tinit < Tend: # Ramp up
-            Trange = [round(Tinit + i*dT,2) for i in range(0,steps+1)] # Temperatures we will visit
-        else:
-            raise ValueError('Detected problem with either Tinit or Tend value, they are probably equal.')
-        logging.debug("Determined as Trange:'%s'" % str(Trange) )
+        Trange = self._temperature_range(Tinit,Tend,dT)            # Temperatures we will visit
+        self.log.debug("Determined as Trange:'%s'", Trange)
         print('Temperature range is given by:\n'+str(Trange))
         waittime = totaltime / len(Trange)                         # Waiting time between steps in sec
-        logging.debug("Time between temperature steps: %f" % (waittime,))
+        self.log.debug("Time between temperature steps: %f", waittime)
         fwaittime = str(datetime.timedelta(seconds=waittime))    # Formatted time for display
         ftotaltime = str(datetime.timedelta(seconds=totaltime))    # Idem dito
         
         print('The waiting time between each step is %s.' % (fwaittime,))
         if waittime <= 10:
-            logging.warning("Ramp settings are chosen with short waiting times!")
+            self.log.warning("Ramp settings are chosen with short waiting times!")
             warnings.warn("The waiting step between 2 temperatures is probably to small for the waterbath to keep up. I suggest you try using a longer time.",)
         print('The total time of this ramp is %s.' % (ftotaltime,))
         
         if ask:
             test = input("Press enter to start ramp, press q to abort.")
             if 'q' in test:
-                logging.info("Ramp aborted before start")
+                self.log.info("Ramp aborted before start")
                 raise ValueError("Aborted measurement before start.")
             else:
                 pass
+        
+        if feedforward:
+            schedule = self._feedforward(Temperature_profile(Tinit).ramp(Tend,totaltime)).setpoints(dT)
+        else:
+            schedule = [(k*waittime,T) for k,T in enumerate(Trange)]
+        self._run_schedule(schedule,totaltime,verbose,late)
             
+        ffinaltime = str(datetime.timedelta(seconds=round(time.perf_counter()-t00)))
+        self.log.info("Ramp finished without error!")
+        print('Ramp completed.\nTotal time of the ramp: %s.' % (ffinaltime,) )
+
+    def run_profile(self,profile,resolution=0.01,ask=True,verbose=False,late='catchup',feedforward=False):
+        '''
+        Runs a Temperature_profile (see there for how to make one). A new 
+        temperature is only sent if the profile moved at least resolution 
+        deg C. ask, verbose, late and feedforward work as in ramp(): with 
+        feedforward, the internal temperature follows the profile.
+        '''
+        if feedforward:
+            profile = self._feedforward(profile)
+        schedule = profile.setpoints(resolution)
+        self.log.info("You selected a profile: %s, with %i setpoints", repr(profile), len(schedule))
+        print('This profile takes %s, and sets the temperature %i times, between %.2f and %.2f deg C.' % (
+            str(datetime.timedelta(seconds=profile.duration)), len(schedule),
+            min(T for _,T in schedule), max(T for _,T in schedule)) )
+        if ask:
+            test = input("Press enter to start profile, press q to abort.")
+            if 'q' in test:
+                self.log.info("Profile aborted before start")
+                raise ValueError("Aborted measurement before start.")
+        t00 = time.perf_counter()
+        self._run_schedule(schedule,profile.duration,verbose,late)
+        ffinaltime = str(datetime.timedelta(seconds=round(time.perf_counter()-t00)))
+        self.log.info("Profile finished without error!")
+        print('Profile completed.\nTotal time of the profile: %s.' % (ffinaltime,) )
+
+    def _run_schedule(self,schedule,totaltime,verbose=False,late='catchup',apply=None):
+        '''
+        Does the actual work for ramp(): sets temperature T at time t for all 
+        (t,T) in schedule (t in seconds after start), and returns after 
+        totaltime seconds. See ramp() for the meaning of late.
+        apply(T) is what sets the temperature, changet() if None.
+        Stores planned and actual time of every step in self.last_ramp, and 
+        prints how far we were off.
+        '''
+        if apply is None:
+            apply = self.changet
+        self._prepare_setpoints([T for _,T in schedule]) # Before t0, so this does not count as being late
         t0=time.perf_counter()
         ft0 = str(datetime.timedelta(seconds=t0))
         
         if verbose:
             print('Starting at internal clock time: %s.' % (ft0,))
         
-        logging.info("Starting ramp now")
+        self.log.info("Starting ramp now")
         print('Starting ramp at:', datetime.datetime.now())
         
-        for T in Trange:
-            tnew = time.perf_counter()
+        self.last_ramp = []
+        for k,(tplanned,T) in enumerate(schedule):
+            self._sleep_until(t0+tplanned)
             tbeforechange = time.perf_counter()
-            if verbose:
-                ftnew = str(datetime.timedelta(seconds=round(time.perf_counter())))
-                print('Internal time - %s\t-\t Changing temperature to %.2f deg C...' % (ftnew,T))
-                
-            print(datetime.datetime.now().time(), "- Changing temperature to %.2f deg C..." % (T,))
-            pasttime = int(round(tnew-t0))
-            fpasttime = str(datetime.timedelta(seconds=pasttime))
-            ftnew = str(datetime.timedelta(seconds=round(time.perf_counter())))
+            step = {'temperature':T, 'planned':tplanned, 'actual':None, 'duration':None}
+            self.last_ramp.append(step)
+            if late == 'skip' and k+1 < len(schedule) and tbeforechange >= t0+schedule[k+1][0]:
+                # The next step is also due allready, so no use in setting this one.
+                self.log.warning("Behind schedule, skipping %.2f deg C", T)
+                continue
             
+            print(datetime.datetime.now().time(), "- Changing temperature to %s deg C..." % (T if isinstance(T,dict) else '%.2f' % T,))
             if verbose:
-                fpasttime = str(datetime.timedelta(seconds=pasttime))
-                ftnew = str(datetime.timedelta(seconds=round(time.perf_counter())))
-                print('Time past since last temperature change: %s.' % (fpasttime,))
+                ftnew = str(datetime.timedelta(seconds=round(tbeforechange)))
                 print('Internal time at changing Temperature - %s' % (ftnew,))
+                print('Behind schedule by %.3f seconds.' % (tbeforechange-t0-tplanned,))
             
-            self.changet(T)
+            apply(T)
             tafterchange = time.perf_counter()
-            
-            tcorrection = tafterchange-tbeforechange
+            step['actual'] = tbeforechange - t0
+            step['duration'] = tafterchange - tbeforechange
             
             if verbose:
-                print('time it took to change Temperature '+str(round(tcorrection)))
-                print('time it took to change Temperature not rounded '+str(tcorrection))
-            
-            # This weird thing makes it possible to interrupt sleeping
-            slptime = math.floor(waittime-tcorrection)
-            for _ in range(slptime):
-                time.sleep(1)
-            time.sleep(waittime-tcorrection-slptime)
-            
-        ffinaltime = str(datetime.timedelta(seconds=round(time.perf_counter()-t00)))
-        logging.info("Ramp finished without error!")
-        print('Ramp completed.\nTotal time of the ramp: %s.' % (ffinaltime,) )
+                print('time it took to change Temperature '+str(round(step['duration'])))
+                print('time it took to change Temperature not rounded '+str(step['duration']))
+        
+        self._sleep_until(t0+totaltime)
+        sent = [s for s in self.last_ramp if s['actual'] is not None]
+        lateness = [s['actual']-s['planned'] for s in sent]
+        message = "Ramp timing: %i of %i steps sent, behind schedule by %.3f seconds on average, %.3f at most, finished %.3f seconds after plan." % (
+            len(sent), len(schedule), sum(lateness)/max(len(lateness),1), max(lateness+[0]), time.perf_counter()-t0-totaltime)
+        self.log.info(message)
+        print(message)
+
+    def _prepare_setpoints(self,setpoints):
+        '''
+        Called by _run_schedule() with all setpoints before the first step. 
+        Children can check them here (raise ValueError if one is impossible,
+        so we find out before instead of halfway the ramp), or prepare the 
+        commands, so there is less to do during the ramp.
+        '''
+        pass
+
+    def _sleep_until(self,deadline):
+        '''
+        Sleep until time.perf_counter() reaches deadline. Sleeps in bits of at
+        most 1 second, this weird thing makes it possible to interrupt 
+        sleeping.
+        '''
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining,1))
 
+    def _temperature_range(self,Tinit,Tend,dT):
+        '''
+        Returns the list of temperatures a block ramp from Tinit to Tend in 
+        steps of dT visits (both ends included). Works for ramping up and down.
+        '''
+        steps = abs(round((Tend-Tinit)/dT))                       # Number of steps
+        if Tinit > Tend: # Ramp down
+            return [round(Tinit - i*dT,2) for i in range(0,steps+1)]
+        elif Tinit < Tend: # Ramp up
+            return [round(Tinit + i*dT,2) for i in range(0,steps+1)]
+        else:
+            raise ValueError('Detected problem with either Tinit or Tend value, they are probably equal.')
 
-    def ramp_steptime(self,Tinit,Tend,dT,steptime,ask=True,verbose=False):
+    def ramp_steptime(self,Tinit,Tend,dT,steptime,ask=True,verbose=False,late='catchup',feedforward=False):
         '''
         Equivalent to ramp(), but uses steptime instead of totaltime    
         Makes a block temperature ramp with device for controlling temperature.
@@ -375,13 +2075,14 @@ class Temperature_controller():
             * ask       : Boolean, if True, will give all experimental info and 
                           wait for user conformation. If False, it will just start.
             * verbose   : Boolean, set to True to get all debug info.
+            * late      : 'catchup' or 'skip', see ramp().
+            * feedforward : see ramp().
         '''
-        steps = abs(round((Tend-Tinit)/dT))                 # Number of steps
-        Trange = [round(Tinit + i*dT,2) for i in range(0,steps+1)] # Temperatures we will visit
+        Trange = self._temperature_range(Tinit,Tend,dT)     # Temperatures we will visit
         totaltime = len(Trange) * steptime
-        self.ramp(Tinit,Tend,dT,totaltime,ask,verbose)
+        self.ramp(Tinit,Tend,dT,totaltime,ask,verbose,late,feedforward)
     
-    def ramp_smooth(self,Tinit,Tend,totaltime,ask=True,verbose=False):
+    def ramp_smooth(self,Tinit,Tend,totaltime,ask=True,verbose=False,late='catchup',feedforward=False):
         '''
         Equivalent to ramp(), but with dT = 0.01 preset.
         Makes a continues temperature ramp (or as close to it as we can with our
@@ -395,38 +2096,169 @@ class Temperature_controller():
                           wait for user conformation. If False, it will just 
                           start.
             * verbose   : Boolean, set to True to get all debug info.
+            * late      : 'catchup' or 'skip', see ramp().
+            * feedforward : see ramp().
         '''
         dT = 0.01
-        self.ramp(Tinit,Tend,dT,totaltime,ask,verbose)
+        self.ramp(Tinit,Tend,dT,totaltime,ask,verbose,late,feedforward)
+    
+    def wait_until_stable(self,tolerance=0.05,window=300,sample_interval=5,timeout=3*3600,target=None,sensor='internal',verbose=False):
+        '''
+        Waits until the temperature has settled, so you don't have to 
+        time.sleep() for a guessed time after changet(). Reads the temperature
+        every sample_interval seconds, and returns as soon as over the last 
+        window seconds (see Rolling_statistics.settled()):
+            * the standard deviation is at most tolerance deg C,
+            * the temperature drifted at most tolerance deg C,
+            * and, if target is given, the mean is within tolerance deg C of
+              target. Without target, a bath that is still creeping towards
+              its set temperature slower than tolerance per window counts as
+              settled. Mind that some baths settle next to their set 
+              temperature (see Thermal_model).
+        sensor is 'internal' or 'external'. Gives up after timeout seconds 
+        with a warning.
+        Returns a dict with 'stable' (True, or False if we gave up), 'time' 
+        (seconds we waited), 'T' (last reading), and the 'mean', 'std', 
+        'slope' (deg C per minute) and number of 'readings' of the window.
+        '''
+        reader = self._settling_reader(sensor)
+        self.log.info("Waiting until the %s temperature is stable within %.3f deg C over %i seconds", sensor, tolerance, window)
+        statistics = Rolling_statistics(window)
+        t0 = time.perf_counter()
+        k = 0
+        while True:
+            elapsed = time.perf_counter() - t0
+            T = reader()
+            statistics.add(elapsed,T)
+            if verbose:
+                print("%.0f s: T = %.2f, mean %.3f, std %.3f, slope %+.4f deg C/min" % (elapsed,T,statistics.mean,statistics.std,60*statistics.slope))
+            stable = elapsed >= window and statistics.settled(tolerance,target)
+            if stable or elapsed >= timeout:
+                break
+            k = k + 1
+            self._sleep_until(t0 + k*sample_interval)
+        result = self._settling_done(statistics.result(stable,elapsed,T))
+        if stable:
+            print("Temperature stable at %.2f deg C after %s." % (result['mean'],str(datetime.timedelta(seconds=round(elapsed)))))
+        return result
+
+    def _settling_reader(self,sensor):
+        '''
+        The function that reads sensor for wait_until_stable().
+        '''
+        readers = {'internal' : self._readtemp_internal,
+                   'external' : self._readtemp_external}
+        if sensor not in readers:
+            raise ValueError("sensor should be 'internal' or 'external', not '%s'" % (sensor,))
+        return readers[sensor]
+
+    def _settling_done(self,result):
+        '''
+        Logs the result of wait_until_stable(), and warns if it gave up. 
+        Returns result.
+        '''
+        if result['stable']:
+            self.log.info("Temperature stable at %.2f deg C after %.0f seconds", result['mean'], result['time'])
+        else:
+            self.log.warning("Temperature not stable after %.0f seconds: %s", result['time'], result)
+            warnings.warn("Temperature not stable after %.0f seconds: mean %.3f, std %.3f, slope %+.4f deg C/min" % (
+                result['time'],result['mean'],result['std'],result['slope']))
+        return result
+    
+    def fit_thermal_model(self,step=1.0,duration=1800,sample_interval=5,history=None,cache=THERMAL_MODEL_CACHE):
+        '''
+        Finds out how the internal temperature of this device follows the set
+        temperature (a Thermal_model), for ramp(..., feedforward=True). 
+        Changes the set temperature by step deg C, reads the internal 
+        temperature every sample_interval seconds for duration seconds 
+        (a few times tau is best) and puts the set temperature back. The bath 
+        should be settled before you start.
+        If you have the readings allready, give them as history (list of 
+        (time in seconds, T_internal, T_set)), then nothing is sent.
+        The model is stored in self.thermal_model and in cache (a JSON file,
+        by class and USB-serial adapter), so next time we don't have to fit 
+        it again. Returns the model.
+        '''
+        if history is None:
+            history = self._step_response(step,duration,sample_interval)
+        model = Thermal_model.fit(history)
+        self.log.info("Fitted thermal model: tau = %.1f s, offset = %+.3f deg C, residual %.2g deg C/s", model.tau, model.offset, model.residual)
+        print("Fitted thermal model: tau = %.1f seconds, offset = %+.2f deg C" % (model.tau,model.offset))
+        self.thermal_model = model
+        if cache is not None:
+            models = _load_cache(cache)
+            models[self._thermal_model_key()] = model.to_dict()
+            _save_cache(cache,models)
+        return model
+    
+    def _step_response(self,step,duration,sample_interval):
+        '''
+        Steps the set temperature by step, and returns the list of (time, 
+        T_internal, T_set) of duration seconds, see fit_thermal_model().
+        '''
+        T_before = self._readtemp_set()
+        T_step = round(T_before + step,2)
+        print("Measuring step response from %.2f to %.2f deg C, this takes %s." % (T_before,T_step,str(datetime.timedelta(seconds=duration))))
+        history = []
+        t0 = time.perf_counter()
+        history.append( (0.0, self._readtemp_internal(), T_before) )
+        self.changet(T_step)
+        k = 0
+        while time.perf_counter() - t0 < duration:
+            k = k + 1
+            self._sleep_until(t0 + k*sample_interval)
+            history.append( (time.perf_counter()-t0, self._readtemp_internal(), T_step) )
+        self.changet(T_before)
+        return history
+    
+    def _thermal_model_key(self):
+        return '%s@%s' % (self.__class__.__name__,_adapter_keys([self.comport])[self.comport])
+    
+    def _feedforward(self,profile,cache=THERMAL_MODEL_CACHE):
+        '''
+        Returns profile shaped with our Thermal_model, loaded from cache if we
+        did not fit one yet. Raises ValueError if there is none.
+        '''
+        if self.thermal_model is None:
+            stored = _load_cache(cache).get(self._thermal_model_key())
+            if stored is None:
+                raise ValueError("No thermal model for %s at comport %s, use fit_thermal_model() first" % (self.__class__.__name__,self.comport))
+            self.thermal_model = Thermal_model.from_dict(stored)
+            self.log.info("Using stored thermal model %s", repr(self.thermal_model))
+        return self.thermal_model.shape(profile)
         
+    @_with_priority(PRIORITY_SETPOINT)
     def changet(self,temp):
         """
         Changes temperature of temperature control unit to temp, and checks if it was succesfull.
         Number will be rounded to 2 decimals. Also print current time because that can be useful.
+        How many attempts it took and how long, is stored in self.last_changet.
         """
         temp = round(temp,2)     # In case somebody still puts in ##.###, note that ##.# or ## is no problem
+        tstart = time.perf_counter()
         self.opencom()
         setcheck=False          # Sometimes setting the temp goes wrong and the first two digits are left out thats why we here check if the actual setpoint is the same as the desired setpoint, or sometimes the whole communication fails with rs232 port 
         i=0
+        polls=0
         while setcheck==False:
             i=i+1
-            logging.debug("Attempt to change temperature to %f using changet() function" % temp)
-            self._set_temperature(temp)
-            time.sleep(1)
-            try:                                         # In case reading data leads to error, disconnect and reconnect (sometimes happens with Julabo)
-                settemp = self._readtemp_set()
+            self.log.debug("Attempt to change temperature to %f using changet() function", temp)
+            try:                                         # In case sending or reading data leads to error, disconnect and reconnect (sometimes happens with Julabo)
+                self._set_temperature(temp)              # electric raises if an acknowledgement is missing
+                settemp, n = self._confirm_setpoint(temp)
+                polls = polls + n
                 setcheck = (settemp==temp or settemp == 0 )    # If settemp is '0', it is unimplemented for whatever reason and we continue without checking.
                 if not setcheck:                         # If temperature was not set correctly, throw an error and handle together with 'real' errors
                     raise serial.SerialException("the wrong temperature was set")
             except Exception as e:
                 ex = str(e)
-                logging.error(ex)
+                self.log.error(ex)
             if not setcheck:
                 if i > 3:
-                    logging.warning("Datatransfer failed %i times in a row" % i)
+                    self.log.warning("Datatransfer failed %i times in a row", i)
                     warnings.warn("Datatransfer failed %i times in a row, try diconnecting and reconnecting the USB cable. I will not throw a real error, because sometimes feedback of machine doesn't work, while temperature is changed corretly." % (i,) )
                     break
-                logging.warning("Something went wrong in datatransfer: '%s'. Try setting temperature again." % (ex, ))
+                self.log.warning("Something went wrong in datatransfer: '%s'. Try setting temperature again.", ex)
                 print("Something went wrong in datatransfer: '%s'.\nTrying again." % (ex, ))
                 self.closecom() # close com and open again to try and restore data connection
                 time.sleep(2)
@@ -435,105 +2267,96 @@ class Temperature_controller():
         #self.closecom()
         if i>1 and setcheck==True:
             print("Recovered from error(s) succesfully.")
-        logging.debug("Temperature set correctly")
-        logging.info("Temperature set to %.2f deg C." % (temp,))
+        # The device told us the new set temperature, so nobody has to ask again.
+        # If it was not confirmed, we don't know what is set now.
+        self._remember('T_set',float(temp) if setcheck else None)
+        latency = time.perf_counter() - tstart
+        self.last_changet = {'temperature' : temp,
+                             'confirmed'   : setcheck,
+                             'attempts'    : i,
+                             'polls'       : polls,
+                             'latency'     : latency}
+        self.log.debug("Temperature set correctly")
+        self.log.info("Temperature set to %.2f deg C. (%i attempt(s), %i readback(s), %.3f seconds)", temp, i, polls, latency)
         # Print confirmation of temperature setting, and current time because usefull.
         print(datetime.datetime.now().time(),"- Temperature set to %.2f deg C." % (temp,) )
 
+    def _confirm_setpoint(self,temp):
+        '''
+        Reads back the set temperature until it equals temp (or '0', which means
+        reading back is not implemented), or until confirm_timeout has passed.
+        Starts reading after confirm_poll seconds, and doubles the wait every 
+        time. Returns the last set temperature read, and the number of reads.
+        If reading keeps failing, the last error is raised.
+        '''
+        deadline = time.perf_counter() + self.confirm_timeout
+        wait = self.confirm_poll
+        polls = 0
+        while True:
+            time.sleep(wait)
+            polls = polls + 1
+            try:
+                settemp = self._readtemp_set()
+                error = None
+            except Exception as e:
+                settemp, error = None, e
+                self.log.debug("Reading back set temperature failed: '%s'", e)
+            if settemp == temp or settemp == 0:
+                return settemp, polls
+            wait = min(2*wait, self.confirm_poll_max)
+            if time.perf_counter() + wait > deadline:
+                if error is not None:
+                    raise error
+                return settemp, polls
+
 
 class Lauda(Temperature_controller):
     '''
     DO NOT USE DIRECTLY, USE FOR INSTANCE 'LaudaE200'!
     This is the metaclass from which all Lauda watherbaths can inherit - since 
-    the raw commands are the same anyway.
+    the raw commands are the same anyway (_LAUDA_COMMANDS, see PROTOCOLS).
     If you change/add a function here, it changes for all Haake waterbaths.
     '''
-    def __init__(self,comport):
-        super().__init__(comport)
-        self.errors = {
-            "ERR_2" : "Wrong input (e.g. buffer overflow)",
-            "ERR_3" : "Wrong command",
-            "ERR_5" : "Syntax Error in value",
-            "ERR_6" : "Illegal Value",
-            "ERR_8" : "Channel (like external temperature) not available",
-            "Err_30": "Programmer, all segements occupied",
-        }
     
     def am_I_in_control(self):
         '''
         Check if the programming interface is in control
         TODO: This throws an error!
         '''
-        logging.debug("Reading whether I can control the Lauda via the programming interface")
-        type_command = "IN MODE 01\r"
-        message = self._in_command(type_command)
-        logging.debug("Raw return of control request is: '%s'" % str(message))
+        self.log.debug("Reading whether I can control the Lauda via the programming interface")
+        message = self._in_command(self._commands['read_control'])
+        self.log.debug("Raw return of control request is: '%s'", message)
         return bool(self._lauda_message_handler(message))
     
     def type(self):
         '''
         Print thermostat type
         '''
-        logging.debug("Reading Lauda thermostat type")
-        type_command = "TYPE\r"
-        message = self._in_command(type_command)
-        logging.debug("Raw type return is: '%s'" % str(message))
+        self.log.debug("Reading Lauda thermostat type")
+        message = self._in_command(self._commands['type'])
+        self.log.debug("Raw type return is: '%s'", message)
         return message
     
     def version(self):
         '''
         Print software version
         '''
-        logging.debug("Reading Lauda thermostat software version")
-        version_command = "VERSION\r"
-        message = self._in_command(version_command)
-        logging.debug("Raw version return is: '%s'" % str(message))
+        self.log.debug("Reading Lauda thermostat software version")
+        message = self._in_command(self._commands['version'])
+        self.log.debug("Raw version return is: '%s'", message)
         return message
-        
-    def _readtemp_internal(self):
-        '''
-        Reads out internal temperature.
-        '''
-        logging.debug("Reading internal temperature")
-        readtemp_I_command = "IN PV 00\r"
-        message = self._in_command(readtemp_I_command)
-        logging.debug("Internal temperature reading is: '%s'" % str(message))
-        return self._lauda_message_handler(message) # Which is temperature parsed from output
-        
-    def _readtemp_external(self):
+    
+    def _lauda_external_handler(self,message):
         '''
-        Reads out external temperature. Usefull if we add sensor to setup 
-        (which we won't do, but you know...).
+        Same as _lauda_message_handler(), but returns -1000 if there is no 
+        external temperature (Lauda says ERR_8).
         '''
-        logging.debug("Reading external temperature")
-        readtemp_E_command = "IN PV 01\r"
-        message = self._in_command(readtemp_E_command)
-        logging.debug("External temperature reading is: '%s'" % str(message))
         try:
             t = self._lauda_message_handler(message) # temperature parsed from output
         except Exception:
             t = -1000 # prevent errors in inhereting stuff.
         return t 
     
-    def _readtemp_set(self):
-        '''
-        Reads out set temperature.
-        '''
-        logging.debug("Reading set temperature")
-        readtemp_S_command = "IN SP 00\r"
-        message = self._in_command(readtemp_S_command)
-        logging.debug("Set temperature reading is: '%s'" % str(message))
-        return self._lauda_message_handler(message) # Which is temperature parsed from output
-    
-    def _set_temperature(self,temperature):
-        '''
-        Changes set temperature of waterbath. DO NOT USE DIRECTLY.
-        '''
-        logging.debug("Changing set temperature to '%s'" % str(temperature) )
-        settemp_command = "OUT SP 00 {0:06.2f}\r".format(float(temperature))
-        self._out_command( settemp_command )
-        logging.debug("Set temperature was changed")
-    
     def set_pumppower(self, power):
         '''
         Sets power of pump to 1,2,3,4, or 5. Turning it off via this way is NOT suported
@@ -541,163 +2364,80 @@ class Lauda(Temperature_controller):
         power = round(power)
         if not (0 < power <= 5):
             raise ValueError("Pumppower must be between 1 and 5")
-        logging.debug("Changing power of pump to '%i'" % (power,) )
-        settemp_command = "OUT SP 01 {0:03}\r".format(power)
-        self._out_command( settemp_command )
-        logging.debug("Pump power was changed")
+        self.log.debug("Changing power of pump to '%i'", power)
+        self._out_command( self._command('set_pumppower',power=power) )
+        self.log.debug("Pump power was changed")
         
     def _lauda_message_handler(self,message):
         '''
         Parses what the Lauda returns into a readable temperature.
-        The Lauda returns something like b'023.45' or b'-015.60' which equals +23.45 and -15.6 degree C. Also possible are errors, like "ERR_2". If you give a command, it will also say OK, meaning there are 2 messages waiting for you, like: b'OK\r\n 033.50\r\n'. We handle that by just only returning the last thing in the list of things you said. Which can be done more elegantly, but this will work in like 99% of cases so why bother.
-        '''
-        # print(message) # For debug
-        # cut off all carriage return (\r) and line feed (\n) commands
-        if type(message) == bytes:
-            message = message.decode()
-        elif type(message) != str:
-            raise TypeError("can only parse string and byte objects, but given type was {0}!".format(type(message)))
-        messages = message.split() # often there is more then one waiting message. This will also clean any \r\n stuff.
-        # only return the last number, probably you are not interested in OK (and ERROR allready gives an error!)
-        parsed = list()
-        for m in messages:
-            parsed.append( self._lauda_parser(m) )
-        return parsed[-1]
-    
-    def _lauda_parser(self,message):
-        """
-        See _lauda_message_handler() for full docs.
-        I require a str as message input here! 
-        """
-        assert type(message) == str
-        message = message.replace('\r\n', '') # just to be sure
-        try:
-            return float(message)
-        except ValueError:
-            # This means the machine says "OK", or there is some error.
-            try:
-                if message == "OK":
-                    return message
-                errormessage = message + " : " + self.errors[message]
-                raise ValueError(errormessage)
-            except KeyError:
-                #print(e) #For debug
-                raise ValueError("Parser could not read Lauda response: '%s'" % (str(message),))
+        The Lauda returns something like b'023.45' or b'-015.60' which equals +23.45 and -15.6 degree C. Also possible are errors, like "ERR_2". If you give a command, it will also say OK, meaning there are 2 messages waiting for you, like: b'OK\r\n 033.50\r\n'. We return the last thing in the list of things you said ('OK' if that is an acknowledgement), and raise ValueError if any of them is an error.
+        '''
+        if isinstance(message,str):
+            message = message.encode()
+        replies = self._parse_replies(message)
+        if not replies:
+            raise ValueError("Parser could not read Lauda response: '%s'" % (message,))
+        for reply in replies:
+            if reply.status == 'error':
+                if reply.error in self.errors:
+                    raise ValueError(reply.error + " : " + self.errors[reply.error])
+                raise ValueError("Parser could not read Lauda response: '%s'" % (reply.error,))
+        if replies[-1].status == 'ack':
+            return 'OK'
+        return replies[-1].value
             
-    def start_pump(self):
-        logging.info("Starting pump and heating/cooling")
-        startpump_command = "START\r"
-        self._out_command( startpump_command )
-        
-    def stop_pump(self):
-        logging.info("Stopping pump and heating/cooling")
-        stoppump_command = "STOP\r"
-        self._out_command( stoppump_command )
+    def _readpump(self):
+        '''
+        IN MODE 02 is 0 if the Lauda is running, 1 if it is in standby.
+        '''
+        self.log.debug("Reading whether the pump is running")
+        message = self._in_command(self._commands['read_pump'])
+        return self._lauda_message_handler(message) == 0
 
 class LaudaE200(Lauda):
     '''
     Class for controlling the Lauda Ecoline E200 waterbath.
     Inherits from Lauda superclass. Look there for the functions you might need.
     '''
+    protocol = 'LaudaE200'
     
-    def __init__(self,comport):
-        logging.info("You selected the Lauda Ecoline E200 Waterbath")
-        super().__init__(comport)
-        self.com = self._initialize_connection(
-            baudrate = 9600, # can be set manually in the machine!    
-            bytesize = serial.EIGHTBITS,
-            parity = serial.PARITY_NONE,
-            stopbits = serial.STOPBITS_ONE,
-            timeout = 15,
-            xonxoff = False,
-            rtscts = True, # set to false if it soes not work!
-            write_timeout = 15,
-            dsrdtr = False,
-            inter_byte_timeout = None
-            )
-        self.opencom()
+    def __init__(self,comport,lazy=False):
+        super().__init__(comport,lazy)
+        self.log.info("You selected the Lauda Ecoline E200 Waterbath")
+        self._connect()
 
 class haake(Temperature_controller):
     '''
     DO NOT USE DIRECTLY, USE FOR INSTANCE 'haakeF6' OR 'haakePhoenix'!
     This is the metaclass from which all Haake watherbaths can inherit - since 
-    the raw commands are the same anyway.
+    the raw commands are the same anyway (_HAAKE_COMMANDS, see PROTOCOLS).
     If you change/add a function here, it changes for all Haake waterbaths.
     '''
-    def __init__(self,comport):
-        super().__init__(comport)
     
-    def _readtemp_internal(self):
-        '''
-        Reads out internal temperature.
-        '''
-        logging.debug("Reading internal temperature")
-        readtemp_I_command = "F1\r"
-        message = self._in_command(readtemp_I_command)
-        logging.debug("Internal temperature reading is: '%s'" % str(message))
-        return self._haake_temp_parser(message) # Which is temperature parsed from output
-        
-    def _readtemp_external(self):
-        '''
-        Reads out external temperature. Usefull if we add sensor to setup 
-        (which we won't do, but you know...).
-        '''
-        logging.debug("Reading external temperature")
-        readtemp_E_command = "F2\r"
-        message = self._in_command(readtemp_E_command)
-        logging.debug("External temperature reading is: '%s'" % str(message))
-        return self._haake_temp_parser(message) # Which is temperature parsed from output
-    
-    def _readtemp_set(self):
-        '''
-        Reads out set temperature.
-        '''
-        logging.debug("Reading set temperature")
-        readtemp_S_command = "R SW\r"
-        message = self._in_command(readtemp_S_command)
-        logging.debug("Set temperature reading is: '%s'" % str(message))
-        return self._haake_temp_parser(message) # Which is temperature parsed from output
-    
-    def _set_temperature(self,temperature):
-        '''
-        Changes set temperature of waterbath. DO NOT USE DIRECTLY, 
-        USE haakeF6.changet() INSTEAD!
-        '''
-        logging.debug("Changing set temperature to '%s'" % str(temperature) )
-        settemp_command = "S  %i\r" % (round(float(temperature) * 100),)
-        self._out_command( settemp_command )
-        logging.debug("Set temperature was changed")
-        
     def _haake_temp_parser(self,message):
         '''
         Parses what the Haake returns into a readable temperature.
         The Haake returns something like b'$\r\nSW+033.99$\r\n' which equals 
-        +33.99 degree C.
+        +33.99 degree C (the leading '$\r\n' is the acknowledgement of an 
+        earlier command). Returns the last temperature in message.
         '''
-        #print(message) #For debug
-        try:
-            return float(message[2:9])
-        except ValueError:
-            # Sorta quick hack: Sometimes, return format is different (it adds leading '$\r\n' for reasons I did not look into), so try other extraction type
-            try:
-                return float(message[5:12])
-            # If it still doesn't work, give detailed error response.
-            except Exception:
-                #print(e) #For debug
-                raise ValueError("Parser could not read haake response: '%s'" % (str(message),))
+        for reply in reversed(self._parse_replies(message)):
+            if reply.status == 'value':
+                return reply.value
+        raise ValueError("Parser could not read haake response: '%s'" % (message,))
 
     def read_RTA_internal(self):
         '''
         Reads the internal temperature correction factor c.
         '''
-        logging.debug("Reading internal RTA values (for temperature correction)")
-        readRTA_I_command = "R CI\r"
-        message = self._in_command( readRTA_I_command )
+        self.log.debug("Reading internal RTA values (for temperature correction)")
+        message = self._in_command( self._commands['read_RTA'] )
         c = self._haake_temp_parser( message )
         time.sleep(1)
         self._flush()
-        logging.debug("Internal RTA factor raw is '%s'" % str(message) )
-        logging.info("Internal RTA factor, c = %s" % str(c))
+        self.log.debug("Internal RTA factor raw is '%s'", message)
+        self.log.info("Internal RTA factor, c = %s", c)
         return c,message
     
     def set_RTA_internal(self,setc):
@@ -707,50 +2447,29 @@ class haake(Temperature_controller):
         NEVER CHANGE THIS IF YOU DO NOT NOW WHAT YOU ARE DOING!
         In case you screw up, +0.50 seems to be a sort of okay value.
         '''
-        logging.warning("I am about to set the internal RTA value to %s!" % str(setc) )
-        setRTA_I_command = "W CI %.2f\r" % (setc,)
-        self._out_command( setRTA_I_command )
-         
-    def start_pump(self):
-        logging.info("Starting pump and heating/cooling")
-        startpump_command = "GO\r"
-        self._out_command( startpump_command )
-        
-    def stop_pump(self):
-        logging.info("Stopping pump and heating/cooling")
-        stoppump_command = "ST\r"
-        self._out_command( stoppump_command )
+        self.log.warning("I am about to set the internal RTA value to %s!", setc)
+        self._out_command( self._command('set_RTA',c=setc) )
     
+    @_with_priority(PRIORITY_SAFETY)
     def alarm(self):
-        logging.warning("Sending the signal to raise the alarm via dataconnection!")
-        alarm_command = "AL\r"
-        self._out_command( alarm_command )
+        self.log.warning("Sending the signal to raise the alarm via dataconnection!")
+        self._out_command( self._commands['alarm'] )
         
     def alarm_stop(self):
-        logging.warning("Stopped alarm via dataconnection!")
-        alarm_stop_command = "ER\r"
-        self._out_command( alarm_stop_command )
+        self.log.warning("Stopped alarm via dataconnection!")
+        self._out_command( self._commands['alarm_stop'] )
     
 class haakeF6(haake):
     '''
     Class for controlling HaakeF6 waterbath.
     Inherits from haake superclass. Look there for the functions you might need.
     '''
+    protocol = 'haakeF6'
     
-    def __init__(self,comport):
-        logging.info("You selected the Haake F6 Waterbath")
-        super().__init__(comport)
-        self.com = self._initialize_connection (baudrate=4800,
-                                          bytesize=serial.EIGHTBITS,
-                                          parity=serial.PARITY_NONE,
-                                          stopbits=serial.STOPBITS_ONE,
-                                          timeout=5,
-                                          xonxoff=False,
-                                          rtscts=False,
-                                          write_timeout=5,
-                                          dsrdtr=False,
-                                          inter_byte_timeout=None)
-        self.opencom()
+    def __init__(self,comport,lazy=False):
+        super().__init__(comport,lazy)
+        self.log.info("You selected the Haake F6 Waterbath")
+        self._connect()
         
         
 class haakePhoenix(haake):
@@ -764,20 +2483,12 @@ class haakePhoenix(haake):
     Always start by starting the pump using haakePhoenix.start_pump(), 
     as it does not start automatically.
     '''
-    def __init__(self,comport):
-        logging.info("You selected the Haake Phoenix Waterbath")
-        super().__init__(comport)
-        self.com = self._initialize_connection(baudrate=9600,
-                                         bytesize=serial.EIGHTBITS,
-                                         parity=serial.PARITY_NONE,
-                                         stopbits=serial.STOPBITS_ONE,
-                                         timeout=5,
-                                         xonxoff=False,
-                                         rtscts=False,
-                                         write_timeout=5,
-                                         dsrdtr=False,
-                                         inter_byte_timeout=None)
-        self.opencom()
+    protocol = 'haakePhoenix'
+    
+    def __init__(self,comport,lazy=False):
+        super().__init__(comport,lazy)
+        self.log.info("You selected the Haake Phoenix Waterbath")
+        self._connect()
 
     
 class julabo(Temperature_controller):
@@ -786,20 +2497,12 @@ class julabo(Temperature_controller):
     (If we ever get another Julabo waterbath, we can convert this to a metaclass
     like 'haake')
     '''
+    protocol = 'julabo'
     
-    def __init__(self,comport):
-        logging.info("You selected the Julabo Waterbath")
-        super().__init__(comport)
-        self.com = self._initialize_connection(baudrate = 4800,
-                                         bytesize=serial.EIGHTBITS,
-                                         parity=serial.PARITY_NONE, 
-                                         stopbits=serial.STOPBITS_ONE,
-                                         timeout=5,
-                                         xonxoff=False,
-                                         rtscts=False,
-                                         write_timeout=5,
-                                         inter_byte_timeout=None)
-        self.opencom()
+    def __init__(self,comport,lazy=False):
+        super().__init__(comport,lazy)
+        self.log.info("You selected the Julabo Waterbath")
+        self._connect()
         
     def _julabo_temp_parser(self,message):
         '''
@@ -810,93 +2513,55 @@ class julabo(Temperature_controller):
             
         The output of the Julabo looks something like this:
             b'\xb26.33\x8d\n'
-        in which 26.33 is the temperature in Celsius.
-        '''
-        logging.debug("Now parsing the temperature from raw output, '%s'" % str(message) )
-        message_cleaned = str(message[0:-2])
-        message_cleaned2 = message_cleaned.replace("\\xb","")
-        message_cleaned3 = message_cleaned2[2:7]
-        logging.debug("Temperature was parsed to '%s'" % str(message_cleaned3) )
-        if '---' in message_cleaned3: # in this case, there is no sensor to read from, just return 0.
-            floated_message = 0.00
-        else:
-            floated_message = float(message_cleaned3)
-        return floated_message
-        
-        
-    def _set_temperature(self,temperature):
+        in which 26.33 is the temperature in Celsius. If there is no sensor to 
+        read from ('---.--'), we return 0.
+        '''
+        self.log.debug("Now parsing the temperature from raw output, '%s'", message)
+        replies = self._parse_replies(message)
+        if not replies or replies[-1].status == 'error':
+            raise ValueError("Parser could not read julabo response: '%s'" % (message,))
+        if replies[-1].status == 'no_sensor':
+            return 0.00
+        return replies[-1].value
+    
+    def _expects_reply(self,command):
+        '''
+        The Julabo answers questions (in_...), but not settings (out_...).
+        '''
+        return not command.startswith(b'out_')
+    
+    def _parse_replies(self,message):
         '''
-        Changes set temperature of waterbath to 'temperature'. 
-        DO NOT USE DIRECTLY, USE changet() INSTEAD!
+        Removes the parity bit first, see _STRIP_PARITY.
         '''
-        logging.debug("Setting temperature to %s" % str(temperature) )
-        settemp_command = "out_sp_00 %06.2f\r" % (float(temperature),)
-        self._out_command( settemp_command )
+        return super()._parse_replies(bytes(message).translate(_STRIP_PARITY))
             
     def status(self):
         '''
         Reads any messages or error codes from the machine.
         '''
-        logging.debug("Reading current status of device")
-        readtemp_I_command = "in_pv_00\r"
-        message = self._in_command( readtemp_I_command )
-        logging.info("current status of device: %s" % str(message) )
+        self.log.debug("Reading current status of device")
+        message = self._in_command( self._commands['read_internal'] )
+        self.log.info("current status of device: %s", message)
         print(message)
-    
-    def _readtemp_set(self):
-        '''
-        Reads out set temperature.
-        '''
-        logging.debug("Reading set temperature")
-        readtemp_S_command = "in_sp_00\r"
-        message = self._in_command( readtemp_S_command )
-        settemp = self._julabo_temp_parser(message)
-        logging.debug("Set temperature reading is: '%s'" % str(settemp))
-        return settemp
-    
-    def _readtemp_internal(self):
-        '''
-        Reads out internal temperature.
-        '''
-        logging.debug("Reading internal temperature")
-        readtemp_I_command = "in_pv_00\r"
-        message = self._in_command( readtemp_I_command )
-        temp = self._julabo_temp_parser(message)
-        logging.debug("Internal temperature reading is: '%s'" % str(temp))
-        return temp
-    
-    def _readtemp_external(self):
-        logging.debug("Reading external temperature")
-        readtemp_E_command = "in_pv_02\r"
-        message = self._in_command( readtemp_E_command )
-        temp = self._julabo_temp_parser(message)
-        logging.debug("External temperature reading is: '%s'" % str(temp))
-        return temp
 
-    def start_pump(self):
-        '''
-        Starts the pump and heating/cooling elements of this waterbath.
-        '''
-        logging.info("Starting pump and heating/cooling")
-        start_P_command = "out_mode_05 1\r"
-        self._out_command( start_P_command )
-        
-    def stop_pump(self):
+    def _readpump(self):
         '''
-        Stops the pump and heating/cooling elements of this waterbath.
+        in_mode_05 is 1 if the Julabo is running, 0 if not.
         '''
-        logging.info("Stoppinh pump and heating/cooling")
-        stop_P_command = "out_mode_05 0\r"
-        self._out_command( stop_P_command )
+        self.log.debug("Reading whether the pump is running")
+        message = self._in_command(self._commands['read_pump'])
+        return self._julabo_temp_parser(message) == 1
         
     def wiggle(self,temp,time=120):
         '''
         This is a TEMPORARY hack, to make sure Julabo stays connected to slow 
         confocal. Works by changing T every 'time' seconds and almost immediatly 
-        changing it back.
+        changing it back. start_keepalive() does the same without changing the
+        temperature, use that instead.
         Just use "ctrl + c" to stop this, it runs ad infinitem.
         '''
-        logging.info("I started the 'wiggle' script. There will be NO log when it stops!")
+        self.log.info("I started the 'wiggle' script. There will be NO log when it stops!")
         while True:
             self.changet(temp+0.01)
             time.sleep(2)
@@ -908,59 +2573,208 @@ class electric(Temperature_controller):
     '''
     Class for controlling the electric peltier-element-based heater.
     Note that we can control the temperature of the three components seperatly by
-    calling electric.set_temperature_controller(temp,[2,3]). The self.changet 
-    and ramp function assume we want to ramp all three components at the same 
-    speed at the same temperature.
-    WARNING: There is no feedback system in place yet to test whether data 
-    transfer is succesfull in the electric control unit. Thread carfully.
+    calling electric.set_temperature_controller(temp,[2,3]), or 
+    electric.set_temperatures({1 : 20, 2 : 25}). The self.changet and ramp 
+    function assume we want to ramp all three components at the same speed at 
+    the same temperature, use run_bank_profiles() to give every bank its own 
+    profile.
+    Frames for all banks are sent in one go, and every controller answers with
+    an acknowledgement that we check. changet() reads back the set temperature
+    of every bank.
     '''
-    def __init__(self,comport):
-        logging.info("You selected the electric temperature controller")
-        logging.warning("The electric temperature controller has no logging functionality (yet)")
-        super().__init__(comport)
-        print('WARNING, the temperature will be set to 22.22 deg C to make sure the comport is configured correctly.')
-        self.com = self._initialize_connection(9600,
-                                         bytesize=serial.SEVENBITS,
-                                         parity=serial.PARITY_EVEN,
-                                         stopbits=serial.STOPBITS_TWO,
-                                         timeout=5,
-                                         xonxoff=False,
-                                         rtscts=False,
-                                         write_timeout=5,
-                                         inter_byte_timeout=None)
-        self.opencom()
-        self._set_temperature(22.22)
+    protocol = 'electric'
+    banks = (1,2,3)
+    # Frames made by _datagenelec(), by (controller, temperature in 0.01 deg C). 
+    # A ramp visits the same temperatures over and over, so we make every 
+    # frame only once. Shared by all electric controllers, frames are the same.
+    _frame_table = {}
+    def __init__(self,comport,lazy=False):
+        super().__init__(comport,lazy)
+        self.log.info("You selected the electric temperature controller")
+        self.log.warning("The electric temperature controller has no logging functionality (yet)")
+        self._connect()
         
     def _datagenelec(self, temp, controller): #
         '''
         Generates data for command to electric control unit.
         enter temp as float (##.## - 2 decimals) and controllor as integer - 1,2 or 3.
+        Frames come from _frame_table if we made them before.
+        '''
+        key = (controller,int(round(temp*100)))     #rounding 
+        frame = self._frame_table.get(key)
+        if frame is None:
+            frame = self._buildframe(*key)
+            self._frame_table[key] = frame
+        return frame
+    
+    def _buildframe(self, controller, centidegrees):
         '''
+        Does the actual work for _datagenelec(), temperature in 0.01 deg C.
+        '''
+        if controller not in self.banks:
+            raise ValueError("Electric controller %s does not exist, choose from %s" % (controller,self.banks))
+        if not -0x80000000 <= centidegrees < 0x80000000:
+            raise ValueError("Temperature %.2f deg C does not fit in a command" % (centidegrees/100,))
         stx=b'\x02'
         etx=b'\x03'
         subadress=b'00'
         SID=b'0'
 
         controllerbit=('0'+str(controller)).encode('UTF-8')    # either 01,02,03
-        command=b'0102C4000000000100000'                    # for changing the set point of the first bank, which is what you want
-        temp=int(round(temp*100))                      #rounding 
-        hexnmb=hex(temp)[2:].upper().encode('UTF-8')
-        data=stx+controllerbit+subadress+SID+command+hexnmb+etx
+        command=self._command('write_setpoint',value=centidegrees & 0xFFFFFFFF) # 8 hex digits, negative numbers as two's complement
+        data=stx+controllerbit+subadress+SID+command+etx
         databcc = data + self._bcccalc(data)
         return databcc
+    
+    def _prepare_setpoints(self,setpoints):
+        '''
+        Makes the frames for every setpoint of a ramp or profile before it 
+        starts (setpoints for all banks, or dicts of {bank : T} for 
+        run_bank_profiles()), so during the ramp they come from _frame_table and
+        an impossible setpoint raises ValueError before we start.
+        '''
+        for T in setpoints:
+            if isinstance(T,dict):
+                for i,Ti in T.items():
+                    self._datagenelec(Ti,i)
+            else:
+                for i in self.banks:
+                    self._datagenelec(T,i)
+        self.log.debug("Prepared frames for %i setpoints, %i frames known", len(setpoints), len(self._frame_table))
+        
+    def _readgenelec(self, controller):
+        '''
+        Generates the command to read the set point of controller (1,2 or 3),
+        the same variable _datagenelec() writes.
+        '''
+        data = b'\x02' + ('%02i' % controller).encode('UTF-8') + b'00' + b'0' + self._commands['read_setpoint'] + b'\x03'
+        return data + self._bcccalc(data)
+        
+    def _handshake(self):
+        '''
+        Reads the set point of all banks, which raises serial.SerialException
+        if the comport is not configured correctly. (This used to set all 
+        banks to 22.22 deg C, which is not what you want after a reconnect.)
+        '''
+        self.log.debug("Set temperatures at connecting are %s", self.read_setpoints())
+        
+    def _identify_command(self):
+        '''
+        Reading the set point of the first bank, see _identify().
+        '''
+        return self._readgenelec(self.banks[0])
         
     def _bcccalc(self,data):
-        bcc=ord(chr(data[1]))
-        for i in range(2,len(data)):
-            bcc=bcc ^ ord(chr(data[i]))  
-        return chr(bcc).encode('UTF-8')
+        '''
+        Block check character: XOR of all bytes after STX, up to and including
+        ETX.
+        '''
+        bcc = 0
+        for b in data[1:]:
+            bcc = bcc ^ b
+        return bytes([bcc])
+    
+    def _cut_frames(self,message):
+        '''
+        A reply is only complete one byte (the BCC) after the ETX.
+        '''
+        frames = []
+        start = 0
+        end = message.find(self.terminator)
+        while end != -1 and end + 1 < len(message):
+            frames.append(message[start:end+2])
+            start = end + 2
+            end = message.find(self.terminator,start)
+        return frames, message[start:]
+    
+    def _parse_reply(self,frame,command):
+        '''
+        Checks a reply of a controller, which looks like
+            STX node(2) subaddress(2) end code(2) command(4) response code(4) data ETX BCC
+        and returns (controller, data). Raises serial.SerialException if the
+        BCC is wrong, it is not the reply to command (like '0102' for writing),
+        or the controller reports an error.
+        '''
+        frame = frame[frame.find(b'\x02'):]
+        if len(frame) < 17 or self._bcccalc(frame[:-1]) != frame[-1:]:
+            raise serial.SerialException("Broken reply from electric controller: '%s'" % (frame,))
+        text = frame[1:-2].decode('UTF-8')
+        if text[4:6] != '00':
+            raise serial.SerialException("Electric controller %s reports end code %s" % (text[0:2],text[4:6]))
+        if text[6:10] != command or text[10:14] != '0000':
+            raise serial.SerialException("Electric controller %s reports response code %s to command %s" % (text[0:2],text[10:14],text[6:10]))
+        return int(text[0:2]), text[14:]
+    
+    def _exchange(self,frames,command):
+        '''
+        Sends all frames in one write, and waits for a reply to each of them. 
+        Returns a dict with the data of every controller that answered. Raises
+        serial.SerialException if any reply is missing or wrong.
+        '''
+        replies = self._in_commands(frames)
+        if len(replies) != len(frames):
+            raise serial.SerialException("Got %i replies to %i commands from electric controller" % (len(replies),len(frames)))
+        return dict(self._parse_reply(reply,command) for reply in replies)
+        
+    def read_setpoints(self,controllers=None):
+        '''
+        Reads the set temperature of every controller (all banks if None), and
+        returns them as a dict, like {1 : 20.0, 2 : 20.0, 3 : 25.0}.
+        '''
+        if controllers is None:
+            controllers = self.banks
+        self.log.debug("Reading set temperature of controller(s) %s", controllers)
+        data = self._exchange([self._readgenelec(i) for i in controllers],'0101')
+        setpoints = {}
+        for i,value in data.items():
+            value = int(value,16)
+            if value >= 0x80000000: # Negative numbers are two's complement
+                value = value - 0x100000000
+            setpoints[i] = value/100
+        self.log.debug("Set temperatures are %s", setpoints)
+        return setpoints
         
     def _readtemp_set(self):
         '''
-        Reads out set temperature.
-        UNIMPLEMENTED FOR THE ELECTRIC CONTROLLER! RETURNS '0' TO PREVENT ERRORS
+        Reads out set temperature. If the banks are not all the same, this is 
+        the one of bank 1, use read_setpoints() to get all of them.
         '''
-        return 0
+        setpoints = self.read_setpoints()
+        if len(set(setpoints.values())) > 1:
+            self.log.info("Banks have different set temperatures: %s", setpoints)
+        return setpoints[self.banks[0]]
+    
+    def _confirm_setpoint(self,temp):
+        '''
+        Every controller allready acknowledged the new set temperature (see 
+        set_temperatures()), so one read back of all banks is enough. Returns 
+        the first set temperature that is not temp (or temp if all are), and 
+        the number of reads.
+        '''
+        for i,settemp in sorted(self.read_setpoints().items()):
+            if settemp != temp:
+                return settemp, 1
+        return temp, 1
+    
+    @_with_priority(PRIORITY_SETPOINT)
+    def set_temperatures(self,setpoints,verbose=True):
+        '''
+        Sets the temperature of several controllers at once, setpoints is a 
+        dict like {1 : 20, 2 : 25}. All frames are sent in one write, and every 
+        controller has to acknowledge, otherwise serial.SerialException is raised.
+        The set temperature of the first bank is remembered for read_set().
+        '''
+        self.log.debug("Setting temperatures %s", setpoints)
+        frames = [self._datagenelec(T,i) for i,T in sorted(setpoints.items())]
+        try:
+            self._exchange(frames,'0102')
+        except Exception:
+            self._remember('T_set',None)    # Some banks may have the new temperature, some not
+            raise
+        first = self.banks[0]
+        self._remember('T_set',int(round(setpoints[first]*100))/100 if first in setpoints else None)
+        if verbose:
+            print("Temperature(s) set to %s deg C." % (', '.join('%i: %.2f' % (i,T) for i,T in sorted(setpoints.items())),) )
         
     def set_temperature_controller(self,temperature,controller,verbose=True):
         '''
@@ -968,11 +2782,41 @@ class electric(Temperature_controller):
         '''
         if type(controller)==type(1):
             controller = [controller]
-        for i in controller:
-            settemp_command = self._datagenelec(temperature,i)
-            self._out_command( settemp_command )
+        self.set_temperatures(dict((i,temperature) for i in controller),False)
         if verbose:
             print("Temperature of controller(s) %s set to %.2f deg C." % (str(controller).strip('[]'),temperature) )
+    
+    def run_bank_profiles(self,profiles,resolution=0.01,ask=True,verbose=False,late='catchup'):
+        '''
+        Runs a different Temperature_profile on every bank, like
+            el.run_bank_profiles({1 : profile_a, 2 : profile_b})
+        Whenever any bank needs a new temperature, the temperatures of all 
+        banks in profiles are sent in one go (so skipping a step with 
+        late='skip' never loses a change). ask, verbose and late work as in 
+        ramp().
+        '''
+        changes = {}
+        for i,profile in profiles.items():
+            for t,T in profile.setpoints(resolution):
+                changes.setdefault(t,{})[i] = T
+        current = {}
+        schedule = []
+        for t in sorted(changes):
+            current.update(changes[t])
+            schedule.append( (t,dict(current)) )
+        duration = max(profile.duration for profile in profiles.values())
+        self.log.info("You selected profiles for banks %s, with %i steps", sorted(profiles), len(schedule))
+        print('These profiles take %s, and set the temperatures %i times.' % (
+            str(datetime.timedelta(seconds=duration)), len(schedule)) )
+        if ask:
+            test = input("Press enter to start profiles, press q to abort.")
+            if 'q' in test:
+                self.log.info("Profiles aborted before start")
+                raise ValueError("Aborted measurement before start.")
+        self._run_schedule(schedule,duration,verbose,late,
+                           apply=lambda setpoints: self.set_temperatures(setpoints,False))
+        self.log.info("Profiles finished without error!")
+        print('Profiles completed.')
         
     def _set_temperature(self,temperature):
         '''
@@ -988,15 +2832,17 @@ class thermo(Temperature_controller):
     ALSO, I DON'T KNOW WHICH WATERBATH THIS IS SUPPOSED TO BE, SO...
     '''
     
-    def __init__(self,comport):
-        logging.info("You selected the Thermo Fischer Waterbath")
-        logging.warning("The Thermo has no logging functionality, and is really in the testing phase!")
-        super().__init__(comport)
-        self.com = self._initialize_connection(9600,bytesize=serial.EIGHTBITS, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE)
-        self.opencom()
+    protocol = 'thermo'
+    
+    def __init__(self,comport,lazy=False):
+        super().__init__(comport,lazy)
+        self.log.info("You selected the Thermo Fischer Waterbath")
+        self.log.warning("The Thermo has no logging functionality, and is really in the testing phase!")
+        self._connect()
         
     def _readtemp_set(self):
-        self.com.write("RS\r".encode()) 
+        self._ensure_connected()
+        self.com.write(self._commands['read_set']) 
         time.sleep(1)
         readlength=self.com.inWaiting()
         #print(readlength)
@@ -1009,7 +2855,7 @@ class thermo(Temperature_controller):
 if __name__ == "__main__":
     # Initialize logging. Logging is usefull, because I can see back when I changed temperatures and stuff like that.
     logginglevel =  logging.INFO # Set to debug if you want to go debugging. Otherwise, leave at info, so we can use the logfile to see what we did in the past.
-    logging.basicConfig(filename='tempcontroller_info.log', level=logginglevel, format='%(asctime)s - %(levelname)s: %(message)s')
+    logging.basicConfig(filename='tempcontroller_info.log', level=logginglevel, format='%(asctime)s - %(name)s - %(levelname)s: %(message)s')
     logging.info('New session was started')
 
     # This checks if you are using a Windows XP machine, and if so, gives a small lecture about the dangers of Windows XP and serialports.
@@ -1021,7 +2867,7 @@ if __name__ == "__main__":
                 logging.warning('Windows XP detected - connection probably unstable!')
                 print("*****I DETECT WINDOWS XP*****")
                 time.sleep(1)
-                warnings.warn("The serial ports have the tendency to loose connection when connected for extended periods of time without commands comming in on this version of Windows. Therefore, I advise using the 'wiggle' function as an alternative to 'changet'. This wiggles the temperature by 0.01 degrees every 2 minutes. This way, connection will not be lost and you will be safe!")
+                warnings.warn("The serial ports have the tendency to loose connection when connected for extended periods of time without commands comming in on this version of Windows. Therefore, I advise using the 'start_keepalive' function after connecting. This checks the connection every minute (without changing anything) if nothing else happens. This way, connection will not be lost and you will be safe!")
                 time.sleep(1)
                 print("*****END OF SAFETY MESSAGE*****")
         except:
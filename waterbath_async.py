@@ -0,0 +1,358 @@
+'''
+asyncio version of the temperature controllers in classywaterbaths.py.
+
+Everything in classywaterbaths.py blocks: a ramp keeps Python busy until it is
+done, so you can only do one thing (with one waterbath) at a time. The classes
+here wrap the normal controllers, so you can 'await' them and drive many
+waterbaths from one event loop. For instance, in a script:
+
+    import asyncio
+    from waterbath_async import *
+
+    async def main():
+        ju = async_julabo('com4')
+        ha = async_haakePhoenix('com5')
+        await asyncio.gather(ju.ramp(20,30,0.1,3600),
+                             ha.passive_logging(15))
+
+    asyncio.run(main())
+
+Every device gets its own worker thread that does the actual (blocking) serial
+communication, so commands to one device are still sent one after the other,
+but waiting for one device does not hold up the others.
+
+If you just want to run ramps on a couple of waterbaths at the same time, you do
+not need to know anything about asyncio, use the Orchestrator:
+
+    orc = Orchestrator()
+    orc.add_ramp(julabo('com4'), 20, 30, 0.1, 3600)
+    orc.add_ramp(haakePhoenix('com5'), 20, 30, 0.1, 3600)
+    orc.run()
+'''
+
+import asyncio
+import concurrent.futures
+import datetime
+import functools
+import logging
+
+from classywaterbaths import Temperature_controller, Rolling_statistics, julabo, haakeF6, haakePhoenix, LaudaE200, electric
+
+
+class AsyncTemperature_controller():
+    '''
+    Wraps a normal (blocking) Temperature_controller, like julabo('com4'), so
+    you can use it with asyncio. All functions that talk to the device are
+    coroutines here, so use 'await ju.changet(30)' instead of 'ju.changet(30)'.
+    The wrapped controller is available as self.controller, if you need
+    something that is not wrapped.
+    '''
+    def __init__(self,controller):
+        self.controller = controller
+        self.comport = controller.comport
+        # One worker per device, so commands to the same comport never overlap.
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def __repr__(self):
+        message = " <%s object controlling comport %s>" % (str(self.__class__),
+                                                            self.comport)
+        return message
+
+    async def _run(self,function,*args,**kwargs):
+        '''
+        Runs blocking function on the worker thread of this device, and waits
+        for it without blocking the event loop.
+        '''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor,
+                                          functools.partial(function,*args,**kwargs))
+
+    def close(self):
+        '''
+        Stops the worker thread and closes the comport.
+        '''
+        self._executor.shutdown(wait=True)
+        self.controller.closecom()
+
+    async def changet(self,temp):
+        '''
+        Async version of Temperature_controller.changet().
+        '''
+        await self._run(self.controller.changet,temp)
+
+    async def _read(self,name,function,max_age):
+        # A fresh enough reading is returned directly, without waiting for the
+        # worker thread (which may be busy with a changet()).
+        value = self.controller._fresh(name,max_age)
+        if value is None:
+            value = await self._run(function,max_age)
+        return value
+
+    async def read_internal(self,max_age=None):
+        '''
+        Returns the internal temperature, see 
+        Temperature_controller.read_internal() for max_age.
+        '''
+        return await self._read('T_internal',self.controller.read_internal,max_age)
+
+    async def read_external(self,max_age=None):
+        '''
+        Returns the external temperature.
+        '''
+        return await self._read('T_external',self.controller.read_external,max_age)
+
+    async def read_set(self,max_age=None):
+        '''
+        Returns the set temperature.
+        '''
+        return await self._read('T_set',self.controller.read_set,max_age)
+
+    async def read_pump(self,max_age=None):
+        '''
+        Returns True if the pump is running, see Temperature_controller.read_pump().
+        '''
+        return await self._read('pump',self.controller.read_pump,max_age)
+
+    async def read_all(self,max_age=None):
+        '''
+        Returns internal, external and set temperature in a dict, see 
+        Temperature_controller.read_all().
+        '''
+        return await self._run(self.controller.read_all,max_age)
+
+    async def start_pump(self):
+        await self._run(self.controller.start_pump)
+
+    async def stop_pump(self):
+        await self._run(self.controller.stop_pump)
+
+    async def passive_logging(self,time_interval=15,verbose=False):
+        '''
+        Async version of Temperature_controller.passive_logging(). Runs until
+        the task is cancelled.
+        '''
+        logging.debug("Start async passive logging on comport %s" % self.comport)
+        loop = asyncio.get_running_loop()
+        tnext = loop.time()
+        while True:
+            temperatures = await self.read_all()
+            tolog = "%s: T_internal = %s, T_external = %s, T_set = %s" % (self.comport,str(temperatures['T_internal']),str(temperatures['T_external']),str(temperatures['T_set']))
+            logging.info(tolog)
+            if verbose:
+                print(tolog)
+            tnext = tnext + time_interval
+            if tnext < loop.time():
+                logging.error("passive_logging time_interval chosen too short")
+                raise ValueError("time_interval too short! Passive logging impossible.")
+            await asyncio.sleep(tnext - loop.time())
+
+    async def wait_until_stable(self,tolerance=0.05,window=300,sample_interval=5,timeout=3*3600,target=None,sensor='internal'):
+        '''
+        Async version of Temperature_controller.wait_until_stable(), returns
+        the same dict. Every reading is a separate job for the device, so 
+        other commands to it don't wait for the whole thing.
+        '''
+        reader = self.controller._settling_reader(sensor)
+        self.controller.log.info("Waiting until the %s temperature is stable within %.3f deg C over %i seconds", sensor, tolerance, window)
+        statistics = Rolling_statistics(window)
+        loop = asyncio.get_running_loop()
+        t0 = loop.time()
+        k = 0
+        while True:
+            elapsed = loop.time() - t0
+            T = await self._run(reader)
+            statistics.add(elapsed,T)
+            stable = elapsed >= window and statistics.settled(tolerance,target)
+            if stable or elapsed >= timeout:
+                break
+            k = k + 1
+            await asyncio.sleep(max(0, t0 + k*sample_interval - loop.time()))
+        return self.controller._settling_done(statistics.result(stable,elapsed,T))
+
+    async def ramp(self,Tinit,Tend,dT,totaltime,verbose=False):
+        '''
+        Async version of Temperature_controller.ramp(). Does not ask for
+        confirmation, because we cannot wait for input() in the event loop.
+        Every step is scheduled at a fixed time after the start of the ramp,
+        so time spent in changet() does not add up.
+
+        IN:
+            * Tinit     : Start temperature of ramp in deg C.
+            * Tend      : Final temperature of ramp in deg C.
+            * dT        : Temperature step of ramp in deg C.
+            * totaltime : Total time of measurement in *seconds*.
+            * verbose   : Boolean, set to True to get all debug info.
+        '''
+        logging.info("%s: You selected a ramp: Tinit=%f, Tend=%f, dT=%f, totaltime=%f" %(self.comport,Tinit,Tend,dT,totaltime))
+        Trange = self.controller._temperature_range(Tinit,Tend,dT)
+        waittime = totaltime / len(Trange)
+        if verbose:
+            print('%s: Temperature range is given by:\n%s' % (self.comport,str(Trange)))
+            print('%s: The waiting time between each step is %s.' % (self.comport,str(datetime.timedelta(seconds=waittime))))
+        loop = asyncio.get_running_loop()
+        t0 = loop.time()
+        logging.info("%s: Starting ramp now" % self.comport)
+        for k,T in enumerate(Trange):
+            await asyncio.sleep(max(0, t0 + k*waittime - loop.time()))
+            await self.changet(T)
+        await asyncio.sleep(max(0, t0 + totaltime - loop.time()))
+        logging.info("%s: Ramp finished without error!" % self.comport)
+        if verbose:
+            print('%s: Ramp completed.' % (self.comport,))
+
+    async def ramp_smooth(self,Tinit,Tend,totaltime,verbose=False):
+        '''
+        Equivalent to ramp(), but with dT = 0.01 preset.
+        '''
+        await self.ramp(Tinit,Tend,0.01,totaltime,verbose)
+
+
+class async_julabo(AsyncTemperature_controller):
+    '''
+    Async version of julabo, use as 'ju = async_julabo('com4')'.
+    '''
+    def __init__(self,comport,lazy=False):
+        super().__init__(julabo(comport,lazy))
+
+
+class async_haakeF6(AsyncTemperature_controller):
+    '''
+    Async version of haakeF6.
+    '''
+    def __init__(self,comport,lazy=False):
+        super().__init__(haakeF6(comport,lazy))
+
+
+class async_haakePhoenix(AsyncTemperature_controller):
+    '''
+    Async version of haakePhoenix.
+    '''
+    def __init__(self,comport,lazy=False):
+        super().__init__(haakePhoenix(comport,lazy))
+
+
+class async_LaudaE200(AsyncTemperature_controller):
+    '''
+    Async version of LaudaE200.
+    '''
+    def __init__(self,comport,lazy=False):
+        super().__init__(LaudaE200(comport,lazy))
+
+
+class async_electric(AsyncTemperature_controller):
+    '''
+    Async version of electric. Use set_temperature_controller() to set the
+    banks seperatly.
+    '''
+    def __init__(self,comport,lazy=False):
+        super().__init__(electric(comport,lazy))
+
+    async def set_temperature_controller(self,temperature,controller,verbose=True):
+        await self._run(self.controller.set_temperature_controller,temperature,controller,verbose)
+
+
+class Orchestrator():
+    '''
+    Runs ramps (or any list of setpoints at given times) on several devices at
+    the same time. All devices use the same clock that starts when you call 
+    run(), so steps planned at the same time on different devices are also 
+    sent at the same time, instead of one after the other.
+    After the run, you get a report with for every step how late it was sent 
+    (drift) and how long changet() took.
+    Controllers can be normal ones (julabo('com4')) or async ones. A normal 
+    one gets a worker thread for the duration of run(), shared by all its 
+    schedules.
+    '''
+    def __init__(self,start_delay=0.5):
+        # start_delay: time in seconds between run() and the first step, so 
+        # all devices are ready when the clock starts.
+        self.start_delay = start_delay
+        self.schedules = []
+        self.report = {}
+
+    def add_schedule(self,controller,schedule):
+        '''
+        Adds a device with a list of (time,temperature) pairs. Time in seconds
+        after the start of run(), temperature in deg C.
+        '''
+        schedule = sorted((float(t),round(T,2)) for t,T in schedule)
+        self.schedules.append( (controller,schedule) )
+
+    def add_ramp(self,controller,Tinit,Tend,dT,totaltime):
+        '''
+        Adds a device with a block ramp, same arguments as 
+        Temperature_controller.ramp().
+        '''
+        blocking = controller.controller if isinstance(controller,AsyncTemperature_controller) else controller
+        Trange = blocking._temperature_range(Tinit,Tend,dT)
+        waittime = totaltime / len(Trange)
+        self.add_schedule(controller,[(k*waittime,T) for k,T in enumerate(Trange)])
+
+    def add_profile(self,controller,profile,resolution=0.01):
+        '''
+        Adds a device with a Temperature_profile, see 
+        Temperature_controller.run_profile().
+        '''
+        self.add_schedule(controller,profile.setpoints(resolution))
+
+    async def _run_device(self,controller,schedule,t0):
+        loop = asyncio.get_running_loop()
+        steps = []
+        for tplanned,T in schedule:
+            await asyncio.sleep(max(0, t0 + tplanned - loop.time()))
+            tsent = loop.time() - t0
+            await controller.changet(T)
+            tdone = loop.time() - t0
+            steps.append({'temperature' : T,
+                          'planned'     : tplanned,
+                          'sent'        : tsent,
+                          'confirmed'   : tdone,
+                          'drift'       : tsent - tplanned})
+        return steps
+
+    async def run_async(self):
+        '''
+        Runs all schedules, returns (and stores in self.report) a dict with 
+        the steps of every schedule, by its index in self.schedules (the order
+        you added them), see summary() for a readable version.
+        '''
+        # One wrapper per normal controller, also if it has several schedules,
+        # so its commands still go through one worker thread.
+        wrappers = {}
+        for c,_ in self.schedules:
+            if isinstance(c,Temperature_controller) and id(c) not in wrappers:
+                wrappers[id(c)] = AsyncTemperature_controller(c)
+        loop = asyncio.get_running_loop()
+        t0 = loop.time() + self.start_delay
+        logging.info("Orchestrator starting %i schedule(s)" % len(self.schedules))
+        try:
+            results = await asyncio.gather(*[self._run_device(wrappers.get(id(c),c),s,t0) for c,s in self.schedules])
+        finally:
+            # Only the worker threads, the comports stay open for the caller
+            for wrapper in wrappers.values():
+                wrapper._executor.shutdown(wait=False)
+        self.report = dict(enumerate(results))
+        logging.info("Orchestrator finished:\n%s" % self.summary())
+        return self.report
+
+    def run(self):
+        '''
+        Blocking version of run_async(), for use in normal scripts.
+        '''
+        return asyncio.run(self.run_async())
+
+    def summary(self):
+        '''
+        Returns a string with the drift of every schedule: how late steps were 
+        sent compared to the plan, and how long it took to confirm them.
+        '''
+        lines = []
+        for k,steps in self.report.items():
+            if not steps:
+                continue
+            drifts = [s['drift'] for s in steps]
+            latencies = [s['confirmed']-s['sent'] for s in steps]
+            lines.append("%i (%s): %i steps, drift mean %.3f s, max %.3f s, changet mean %.3f s, max %.3f s" %
+                         (k,self.schedules[k][0].comport,len(steps),sum(drifts)/len(drifts),max(drifts),
+                          sum(latencies)/len(latencies),max(latencies)))
+        return "\n".join(lines)
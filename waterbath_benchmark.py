@@ -0,0 +1,161 @@
+'''
+Benchmarks for the communication with the temperature controllers.
+
+Runs against the simulated devices of waterbath_simulator.py, so you don't need
+a waterbath. Measures:
+    * latency   : time per question (reading the internal temperature, or the
+                  set temperature if a model has no command for that).
+    * changet   : time changet() takes until the set temperature is confirmed.
+    * ramp      : how far a (compressed) ramp is off from its planned times.
+    * logging   : how many samples per second passive logging could take
+                  (read_all() as fast as possible).
+Results are printed and saved as JSON, so you can compare before and after a
+change. Run from the command line, for instance:
+
+    python waterbath_benchmark.py --models julabo LaudaE200 --output before.json
+    python waterbath_benchmark.py --baudrate 9600 --latency 0.05
+
+Every model uses the baudrate its class uses (4800 for julabo and haakeF6, 9600
+for the others), unless you give --baudrate.
+'''
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import logging
+import os
+import platform
+import subprocess
+import time
+import warnings
+
+import classywaterbaths
+import waterbath_simulator
+
+MODELS = ['julabo','haakeF6','haakePhoenix','LaudaE200','electric']
+
+
+def percentiles(values):
+    '''
+    Returns a dict with mean, 50th, 90th and 99th percentile and max of values.
+    '''
+    values = sorted(values)
+    def p(q):
+        return values[min(len(values)-1,int(q/100*len(values)))]
+    return {'n'    : len(values),
+            'mean' : sum(values)/len(values),
+            'p50'  : p(50),
+            'p90'  : p(90),
+            'p99'  : p(99),
+            'max'  : values[-1]}
+
+
+def bench_latency(controller,n):
+    # A device without a read_internal command (electric) answers that 
+    # without asking anything, so time reading the set temperature instead.
+    if 'read_internal' in controller._commands:
+        name, reader = 'internal', controller._readtemp_internal
+    else:
+        name, reader = 'set', controller._readtemp_set
+    times = []
+    for _ in range(n):
+        t = time.perf_counter()
+        reader()
+        times.append(time.perf_counter()-t)
+    result = percentiles(times)
+    result['reading'] = name
+    return result
+
+
+def bench_changet(controller,n):
+    times = []
+    attempts = []
+    for i in range(n):
+        t = time.perf_counter()
+        controller.changet(20 + 0.01*(i % 2 + 1))
+        times.append(time.perf_counter()-t)
+        attempts.append(controller.last_changet['attempts'])
+    result = percentiles(times)
+    result['attempts_max'] = max(attempts)
+    return result
+
+
+def bench_ramp(controller,steps,totaltime):
+    controller.ramp(20,20+0.01*(steps-1),0.01,totaltime,ask=False)
+    lateness = [s['actual']-s['planned'] for s in controller.last_ramp if s['actual'] is not None]
+    result = percentiles(lateness)
+    result['steps'] = len(controller.last_ramp)
+    result['steps_sent'] = len(lateness)
+    result['totaltime'] = totaltime
+    return result
+
+
+def bench_logging(controller,duration):
+    n = 0
+    t0 = time.perf_counter()
+    while time.perf_counter() - t0 < duration:
+        controller.read_all()
+        n = n + 1
+    return {'samples' : n, 'samples_per_second' : n/(time.perf_counter()-t0)}
+
+
+def run(models,baudrate=None,latency=0.02,jitter=0.0,n=50,ramp_steps=50,ramp_time=10.0,logging_time=5.0):
+    '''
+    Runs all benchmarks on every model, returns the results as a dict.
+    '''
+    results = {}
+    for model in models:
+        comport = waterbath_simulator.simulate(model,latency=latency,jitter=jitter,seed=1)
+        with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            controller = getattr(classywaterbaths,model)(comport)
+            if baudrate is not None:
+                controller.com.baudrate = baudrate
+            results[model] = {
+                'baudrate' : controller.com.baudrate,
+                'latency'  : bench_latency(controller,n),
+                'changet'  : bench_changet(controller,n),
+                'ramp'     : bench_ramp(controller,ramp_steps,ramp_time),
+                'logging'  : bench_logging(controller,logging_time),
+                }
+            controller.closecom()
+        print("%-13s latency p50 %7.1f ms  changet p50 %7.1f ms  ramp late max %6.1f ms  logging %6.1f samples/s" % (
+            model, 1000*results[model]['latency']['p50'], 1000*results[model]['changet']['p50'],
+            1000*results[model]['ramp']['max'], results[model]['logging']['samples_per_second']))
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git','rev-parse','HEAD'],stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the temperature controllers against simulated devices.")
+    parser.add_argument('--models',nargs='+',default=MODELS,choices=MODELS)
+    parser.add_argument('--baudrate',type=int,default=None,help="Baudrate for all models (default: what the class uses)")
+    parser.add_argument('--latency',type=float,default=0.02,help="Answer latency of the simulated devices in seconds")
+    parser.add_argument('--jitter',type=float,default=0.0,help="Random extra latency in seconds")
+    parser.add_argument('-n',type=int,default=50,help="Number of commands for latency and changet")
+    parser.add_argument('--ramp-steps',type=int,default=50)
+    parser.add_argument('--ramp-time',type=float,default=10.0,help="Total time of the ramp in seconds")
+    parser.add_argument('--logging-time',type=float,default=5.0,help="Time to measure logging throughput in seconds")
+    parser.add_argument('--output',default='benchmark.json',help="JSON file to write the results to")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    results = run(args.models,args.baudrate,args.latency,args.jitter,args.n,
+                  args.ramp_steps,args.ramp_time,args.logging_time)
+    report = {'commit'    : git_commit(),
+              'timestamp' : datetime.datetime.now().isoformat(),
+              'python'    : platform.python_version(),
+              'settings'  : vars(args),
+              'results'   : results}
+    with open(args.output,'w') as f:
+        json.dump(report,f,indent=2)
+    print("Results written to '%s'" % (args.output,))
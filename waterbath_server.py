@@ -0,0 +1,392 @@
+'''
+A device server, so more than one program can use the waterbaths at once.
+
+A comport can only be opened by one program. Normally that is whatever Spyder
+session said 'ju = julabo('com4')' first, and nothing else on the PC can read
+the temperature. The server here owns all controllers, and other programs (the
+microscope software, a second Spyder, a plotting script) talk to it over a local
+TCP socket. Start it from the command line:
+
+    python waterbath_server.py ju=julabo:com4 ha=haakePhoenix:com5
+
+or from Python:
+
+    server = DeviceServer()
+    server.add('ju',julabo('com4'))
+    server.serve_forever()
+
+Then, in any other program:
+
+    from waterbath_server import WaterbathClient
+    bath = WaterbathClient()
+    bath.read('ju')                 # {'time': ..., 'T_internal': ..., ...}
+    bath.set('ju',25)
+    bath.ramp('ju',20,30,0.1,3600)
+    for sample in bath.subscribe('ju'):
+        print(sample)
+
+The server reads every device every poll_interval seconds on its own thread,
+and keeps the newest reading. read() just returns that reading, so clients can
+ask as often as they like (10 times per second is fine) without ever touching
+the serial line, and without slowing down a ramp.
+
+The protocol is one JSON object per line, in both directions. A request is
+{"cmd": ..., other arguments}, the answer is {"ok": true, "result": ...} or
+{"ok": false, "error": "..."}. Commands:
+    * devices                                       : names and classes.
+    * read       device                             : newest reading.
+    * set        device, temperature                : changet().
+    * ramp       device, Tinit, Tend, dT, totaltime : start a ramp.
+    * status     device                             : is a ramp running?
+    * start_pump / stop_pump  device
+    * subscribe  device (optional)                  : after the answer, every
+                   new reading is sent as a line, until the client disconnects.
+Only connections from this PC are accepted by default (host 127.0.0.1).
+'''
+
+import argparse
+import json
+import logging
+import queue
+import socket
+import socketserver
+import threading
+import time
+
+import classywaterbaths
+
+DEFAULT_PORT = 5025
+
+
+class _Device():
+    '''
+    One controller on the server: polls it on its own thread, keeps the newest
+    reading and sends it to all subscribers.
+    '''
+    def __init__(self,name,controller,poll_interval):
+        self.name = name
+        self.controller = controller
+        self.poll_interval = poll_interval
+        self.latest = None
+        self.subscribers = []
+        self.ramp_thread = None
+        self.ramp_error = None
+        self._subscribers_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._poll,daemon=True,name="server poll %s" % name)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _poll(self):
+        tnext = time.perf_counter()
+        while not self._stop.is_set():
+            try:
+                # read_all() takes the lock of the controller, so a ramp or a
+                # set command waits at most for one reading. Readings go last 
+                # if others are waiting.
+                with self.controller.priority(classywaterbaths.PRIORITY_TELEMETRY):
+                    sample = dict(self.controller.read_all(),time=time.time())
+                self.latest = sample
+                self._publish(sample)
+            except Exception as e:
+                self.controller.log.warning("Server reading failed: '%s'", e)
+            tnext = tnext + self.poll_interval
+            if tnext < time.perf_counter():
+                tnext = time.perf_counter() # Reading is slower than poll_interval, do not catch up
+            self._stop.wait(tnext - time.perf_counter())
+
+    def _publish(self,sample):
+        message = dict(sample,device=self.name)
+        with self._subscribers_lock:
+            subscribers = list(self.subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(message)
+            except queue.Full:
+                # Slow client: drop its oldest sample rather than hold up the rest.
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    pass
+                try:
+                    q.put_nowait(message)
+                except queue.Full:
+                    pass    # The poll thread of another device refilled it (subscribe to all devices), drop this one
+
+    def subscribe(self,q):
+        with self._subscribers_lock:
+            self.subscribers.append(q)
+
+    def unsubscribe(self,q):
+        with self._subscribers_lock:
+            if q in self.subscribers:
+                self.subscribers.remove(q)
+
+    def ramp_running(self):
+        return self.ramp_thread is not None and self.ramp_thread.is_alive()
+
+    def start_ramp(self,Tinit,Tend,dT,totaltime):
+        if self.ramp_running():
+            raise RuntimeError("A ramp is already running on %s" % self.name)
+        self.ramp_error = None
+        def run():
+            try:
+                self.controller.ramp(Tinit,Tend,dT,totaltime,ask=False)
+            except Exception as e:
+                self.controller.log.exception("Ramp started by server failed")
+                self.ramp_error = str(e)
+        self.ramp_thread = threading.Thread(target=run,daemon=True,name="server ramp %s" % self.name)
+        self.ramp_thread.start()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    '''
+    Handles one client connection, one JSON request per line.
+    '''
+    def handle(self):
+        server = self.server.device_server
+        for line in self.rfile:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line.decode())
+                if request.get('cmd') == 'subscribe':
+                    self._subscribe(server,request.get('device'))
+                    return
+                answer = {'ok' : True, 'result' : server.handle(request)}
+            except Exception as e:
+                answer = {'ok' : False, 'error' : '%s: %s' % (e.__class__.__name__,e)}
+            self._send(answer)
+
+    def _send(self,message):
+        self.wfile.write((json.dumps(message) + '\n').encode())
+        self.wfile.flush()
+
+    def _subscribe(self,server,name):
+        devices = [server.device(name)] if name is not None else list(server.devices.values())
+        q = queue.Queue(maxsize=100)
+        for device in devices:
+            device.subscribe(q)
+        try:
+            self._send({'ok' : True, 'result' : [d.name for d in devices]})
+            while not self.server.stopping:
+                try:
+                    message = q.get(timeout=1)
+                except queue.Empty:
+                    continue
+                self._send(message)
+        except OSError:
+            pass # Client went away
+        finally:
+            for device in devices:
+                device.unsubscribe(q)
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    stopping = False
+
+
+class DeviceServer():
+    '''
+    Owns a couple of controllers and serves them over TCP on host:port. Add
+    controllers with add(), then call serve_forever() (blocks, stop with
+    ctrl+c) or start() (runs on the background, stop with shutdown()).
+    poll_interval is the time in seconds between readings of every device.
+    '''
+    def __init__(self,host='127.0.0.1',port=DEFAULT_PORT,poll_interval=1.0):
+        self.host = host
+        self.port = port
+        self.poll_interval = poll_interval
+        self.devices = {}
+        self._server = None
+        self._thread = None
+
+    def __repr__(self):
+        return " <DeviceServer on %s:%i with %s>" % (self.host,self.port,', '.join(self.devices))
+
+    def add(self,name,controller):
+        '''
+        Adds a controller (i.e. julabo('com4')) under name.
+        '''
+        if name in self.devices:
+            raise ValueError("There is already a device called '%s'" % name)
+        self.devices[name] = _Device(name,controller,self.poll_interval)
+        if self._server is not None:
+            self.devices[name].start()
+
+    def device(self,name):
+        if name not in self.devices:
+            raise KeyError("Unknown device '%s', choose from %s" % (name,list(self.devices)))
+        return self.devices[name]
+
+    def handle(self,request):
+        '''
+        Executes one request (a dict) and returns the result.
+        '''
+        cmd = request.get('cmd')
+        if cmd == 'devices':
+            return {name : d.controller.__class__.__name__ for name,d in self.devices.items()}
+        device = self.device(request.get('device'))
+        if cmd == 'read':
+            return device.latest
+        if cmd == 'set':
+            device.controller.changet(float(request['temperature']))
+            return device.controller.last_changet
+        if cmd == 'ramp':
+            device.start_ramp(float(request['Tinit']),float(request['Tend']),
+                              float(request['dT']),float(request['totaltime']))
+            return True
+        if cmd == 'status':
+            return {'ramp_running' : device.ramp_running(),
+                    'ramp_error'   : device.ramp_error,
+                    'latest'       : device.latest}
+        if cmd == 'start_pump':
+            device.controller.start_pump()
+            return True
+        if cmd == 'stop_pump':
+            device.controller.stop_pump()
+            return True
+        raise ValueError("Unknown command '%s'" % (cmd,))
+
+    def start(self):
+        '''
+        Starts polling and serving on background threads.
+        '''
+        self._server = _TCPServer((self.host,self.port),_Handler)
+        self._server.device_server = self
+        self.port = self._server.server_address[1] # In case port was 0
+        for device in self.devices.values():
+            device.start()
+        self._thread = threading.Thread(target=self._server.serve_forever,daemon=True,name="device server")
+        self._thread.start()
+        logging.info("Device server listening on %s:%i for %s" % (self.host,self.port,', '.join(self.devices)))
+
+    def shutdown(self):
+        '''
+        Stops serving and polling. Does not close the comports.
+        '''
+        self._server.stopping = True
+        self._server.shutdown()
+        self._server.server_close()
+        for device in self.devices.values():
+            device.stop()
+        self._server = None
+        logging.info("Device server stopped")
+
+    def serve_forever(self):
+        '''
+        start(), and wait until ctrl+c.
+        '''
+        self.start()
+        print("Serving %s on %s:%i. Press ctrl+c to stop." % (', '.join(self.devices),self.host,self.port))
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            print("Stopping device server.")
+        finally:
+            self.shutdown()
+
+
+class WaterbathClient():
+    '''
+    Talks to a DeviceServer. Every function sends one request and waits for
+    the answer, errors on the server are raised as RuntimeError.
+    '''
+    def __init__(self,host='127.0.0.1',port=DEFAULT_PORT,timeout=10):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._socket = socket.create_connection((host,port),timeout=timeout)
+        self._file = self._socket.makefile('rwb')
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return " <WaterbathClient connected to %s:%i>" % (self.host,self.port)
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+    def request(self,cmd,**arguments):
+        with self._lock:
+            self._file.write((json.dumps(dict(arguments,cmd=cmd)) + '\n').encode())
+            self._file.flush()
+            answer = json.loads(self._file.readline().decode())
+        if not answer['ok']:
+            raise RuntimeError(answer['error'])
+        return answer['result']
+
+    def devices(self):
+        return self.request('devices')
+
+    def read(self,device):
+        '''
+        Newest reading of device: dict with time, T_internal, T_external and
+        T_set. Does not wait for the device.
+        '''
+        return self.request('read',device=device)
+
+    def set(self,device,temperature):
+        return self.request('set',device=device,temperature=temperature)
+
+    def ramp(self,device,Tinit,Tend,dT,totaltime):
+        '''
+        Starts a ramp on the server (see Temperature_controller.ramp()), and
+        returns directly. Use status() to see if it is still running.
+        '''
+        return self.request('ramp',device=device,Tinit=Tinit,Tend=Tend,dT=dT,totaltime=totaltime)
+
+    def status(self,device):
+        return self.request('status',device=device)
+
+    def start_pump(self,device):
+        return self.request('start_pump',device=device)
+
+    def stop_pump(self,device):
+        return self.request('stop_pump',device=device)
+
+    def subscribe(self,device=None):
+        '''
+        Yields every new reading of device (all devices if None) as a dict,
+        with the name of the device in 'device'. Uses its own connection, so
+        this client can still be used for other requests.
+        '''
+        with socket.create_connection((self.host,self.port),timeout=self.timeout) as s:
+            f = s.makefile('rwb')
+            f.write((json.dumps({'cmd' : 'subscribe', 'device' : device}) + '\n').encode())
+            f.flush()
+            answer = json.loads(f.readline().decode())
+            if not answer['ok']:
+                raise RuntimeError(answer['error'])
+            s.settimeout(None)
+            for line in f:
+                yield json.loads(line.decode())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve waterbaths to other programs over a local socket.")
+    parser.add_argument('devices',nargs='+',metavar='name=class:comport',
+                        help="For instance ju=julabo:com4")
+    parser.add_argument('--host',default='127.0.0.1')
+    parser.add_argument('--port',type=int,default=DEFAULT_PORT)
+    parser.add_argument('--poll-interval',type=float,default=1.0,help="Seconds between readings of every device")
+    args = parser.parse_args()
+
+    logging.basicConfig(filename='tempcontroller_info.log',
+                        format='%(asctime)s - %(name)s - %(levelname)s: %(message)s',
+                        level=logging.INFO)
+    server = DeviceServer(args.host,args.port,args.poll_interval)
+    for spec in args.devices:
+        name,_,rest = spec.partition('=')
+        classname,_,comport = rest.partition(':')
+        server.add(name,getattr(classywaterbaths,classname)(comport))
+    server.serve_forever()
@@ -0,0 +1,517 @@
+'''
+Simulated waterbaths, so you can try things out without the real machine.
+
+Every device class in classywaterbaths.py can talk to a simulated device
+instead of a real comport. The simulated device speaks the same protocol as
+the real one (including the weird bits, like the Julabo parity bit, the Haake
+'$\\r\\n' and the Lauda 'OK'), takes the time the serial line would take at the
+baudrate the class asks for, and has a waterbath that slowly follows its set
+temperature. Use it like:
+
+    import waterbath_simulator
+    url = waterbath_simulator.simulate('julabo',latency=0.05,speedup=100)
+    ju = julabo(url)            # url is something like 'sim://julabo-1'
+    ju.changet(30)
+
+'speedup' makes the waterbath 100 times faster, so a ramp of a day can be
+replayed in 15 minutes (if you also make the ramp 100 times shorter).
+
+Options of simulate(), for all devices:
+    * T         : Starting temperature (and set temperature) in deg C.
+    * tau       : Time constant of the waterbath in seconds (how slow it follows
+                  the set temperature).
+    * speedup   : Factor to speed up the thermal behaviour with.
+    * latency   : Time in seconds the device takes before it answers.
+    * jitter    : Random extra time (between 0 and jitter seconds) on top of
+                  latency.
+    * drop_rate : Chance that a byte of an answer gets lost on the way.
+    * external  : Offset of the external sensor with respect to the internal
+                  temperature in deg C, or None if there is no external sensor.
+    * seed      : Seed for the random numbers, to make runs repeatable.
+    * offset    : The bath settles at the set temperature plus offset in deg C
+                  (like the Haake Phoenix, which is about 0.8 deg C too warm).
+    * baudrate  : Baudrate the device is set to. Commands sent at another 
+                  baudrate are noise to it, so it does not answer. None (the
+                  default) understands every baudrate.
+
+get_device(comport).disconnect() simulates a USB hiccup: the open port stops
+working until it is opened again.
+
+This works by registering 'sim://' as a pyserial URL handler, which
+Temperature_controller._initialize_connection() uses for every comport that
+looks like an URL.
+'''
+
+import math
+import random
+import sys
+import threading
+import time
+import types
+
+import serial
+
+
+class _Thermal():
+    '''
+    First order model of a waterbath: the temperature moves towards the set
+    temperature (plus offset) with time constant tau (in seconds), speedup 
+    times faster than real time. Only heats/cools while running.
+    '''
+    def __init__(self,T,tau,speedup,offset=0.0):
+        self.setpoint = T
+        self.T = T + offset
+        self.offset = offset
+        self.tau = tau
+        self.speedup = speedup
+        self.running = True
+        self._t = time.perf_counter()
+
+    def temperature(self):
+        now = time.perf_counter()
+        if self.running:
+            factor = 1 - math.exp(-(now-self._t)*self.speedup/self.tau)
+            self.T = self.T + (self.setpoint+self.offset-self.T)*factor
+        self._t = now
+        return self.T
+
+
+class SimulatedBath():
+    '''
+    Base class of the simulated devices. Takes care of timing: commands come in
+    through receive(), the answer of handle() is put in the outgoing queue with
+    the time every byte would arrive at the PC.
+    Children implement handle(command), which gets one command (without
+    separator) and returns the answer in bytes, or None if there is none.
+    '''
+    separator = b'\r'   # Every command ends with this
+
+    def __init__(self,T=20.0,tau=300.0,speedup=1.0,latency=0.02,jitter=0.0,
+                 drop_rate=0.0,external=None,seed=None,baudrate=None,offset=0.0):
+        self.thermal = _Thermal(T,tau,speedup,offset)
+        self.baudrate = baudrate
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.external = external
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.received = []      # All commands we got, for checking what happened
+        self._incoming = b''
+        self._outgoing = []     # List of (arrival time, byte)
+        self._busy_until = 0
+        self.generation = 0     # Goes up on disconnect(), makes open ports stale
+
+    def _split_commands(self,data):
+        '''
+        Returns complete commands in data, and the incomplete rest.
+        '''
+        parts = data.split(self.separator)
+        return parts[:-1], parts[-1]
+
+    def receive(self,data,now,char_time):
+        '''
+        Data is written by the PC at time now, every byte takes char_time
+        seconds on the line.
+        '''
+        with self.lock:
+            tarrival = now - len(self._incoming)*char_time
+            self._incoming = self._incoming + data
+            commands, self._incoming = self._split_commands(self._incoming)
+            for command in commands:
+                tarrival = tarrival + (len(command)+len(self.separator))*char_time
+                self.received.append(command)
+                reply = self.handle(command)
+                if reply:
+                    self._schedule(reply,tarrival,char_time)
+
+    def _schedule(self,reply,tready,char_time):
+        tstart = max(tready + self.latency + self.random.uniform(0,self.jitter),
+                     self._busy_until)
+        for i in range(len(reply)):
+            if self.drop_rate and self.random.random() < self.drop_rate:
+                continue
+            self._outgoing.append( (tstart+(i+1)*char_time, reply[i:i+1]) )
+        self._busy_until = tstart + len(reply)*char_time
+
+    def available(self,now):
+        '''
+        Number of bytes that arrived at the PC at time now.
+        '''
+        with self.lock:
+            n = 0
+            for tarrival,_ in self._outgoing:
+                if tarrival > now:
+                    break
+                n = n + 1
+            return n
+
+    def next_arrival(self):
+        '''
+        Time at which the next byte arrives, or None if nothing is coming.
+        '''
+        with self.lock:
+            if self._outgoing:
+                return self._outgoing[0][0]
+            return None
+
+    def take(self,n,now):
+        '''
+        Takes at most n bytes that arrived at time now.
+        '''
+        with self.lock:
+            data = b''
+            while self._outgoing and len(data) < n and self._outgoing[0][0] <= now:
+                data = data + self._outgoing.pop(0)[1]
+            return data
+
+    def discard(self,now):
+        '''
+        Throws away everything that already arrived (flushInput on the PC).
+        '''
+        with self.lock:
+            self._outgoing = [b for b in self._outgoing if b[0] > now]
+
+    def disconnect(self):
+        '''
+        Simulates pulling out the USB cable and plugging it back in: every port
+        that is open now fails until it is opened again.
+        '''
+        with self.lock:
+            self.generation = self.generation + 1
+            self._incoming = b''
+            self._outgoing = []
+
+    @property
+    def internal(self):
+        return self.thermal.temperature()
+
+    @property
+    def external_temperature(self):
+        if self.external is None:
+            return None
+        return self.internal + self.external
+
+    def handle(self,command):
+        raise NotImplementedError
+
+
+def _even_parity(data):
+    '''
+    The Julabo sends 7 data bits with even parity, which we read as 8 bits
+    without parity. So the parity bit shows up as the highest bit.
+    '''
+    result = bytearray()
+    for b in data:
+        if bin(b).count('1') % 2:
+            b = b | 0x80
+        result.append(b)
+    return bytes(result)
+
+
+class SimulatedJulabo(SimulatedBath):
+    '''
+    Julabo F25: no answer to out_ commands, answers to in_ commands look like
+    b'\\xb26.33\\x8d\\n'.
+    '''
+    def _reply(self,text):
+        return _even_parity((text+'\r').encode()) + b'\n'
+
+    def handle(self,command):
+        command = command.decode(errors='replace').strip()
+        if command == 'in_pv_00':
+            return self._reply('%.2f' % self.internal)
+        elif command == 'in_pv_02':
+            if self.external is None:
+                return self._reply('---.--')
+            return self._reply('%.2f' % self.external_temperature)
+        elif command == 'in_sp_00':
+            return self._reply('%.2f' % self.thermal.setpoint)
+        elif command == 'in_mode_05':
+            return self._reply('%i' % self.thermal.running)
+        elif command == 'version':
+            return self._reply('JULABO F25 VERSION 1.00')
+        elif command.startswith('out_sp_00 '):
+            self.thermal.temperature()
+            self.thermal.setpoint = round(float(command.split()[1]),2)
+        elif command.startswith('out_mode_05 '):
+            self.thermal.temperature()
+            self.thermal.running = command.split()[1] == '1'
+        return None
+
+
+class SimulatedHaake(SimulatedBath):
+    '''
+    Haake F6 and Phoenix: every answer ends with '$\\r\\n', commands without
+    answer just get '$\\r\\n'.
+    Unknown commands get the error 'F001$\\r\\n'.
+    '''
+    ack = b'$\r\n'
+
+    def _reply(self,prefix,T):
+        return ('%s%+07.2f' % (prefix,T)).encode() + self.ack
+
+    def handle(self,command):
+        command = command.decode(errors='replace').strip()
+        if command == 'F1':
+            return self._reply('F1',self.internal)
+        elif command == 'F2':
+            return self._reply('F2',self.internal if self.external is None else self.external_temperature)
+        elif command == 'R SW':
+            return self._reply('SW',self.thermal.setpoint)
+        elif command == 'R CI':
+            return self._reply('CI',0.5)
+        elif command.startswith('S '):
+            self.thermal.temperature()
+            self.thermal.setpoint = int(command[1:].strip())/100
+        elif command in ('GO','ST'):
+            self.thermal.temperature()
+            self.thermal.running = command == 'GO'
+        elif not (command.startswith('W ') or command in ('AL','ER')):
+            return b'F001' + self.ack   # Unknown command
+        return self.ack
+
+
+class SimulatedLauda(SimulatedBath):
+    '''
+    Lauda Ecoline: answers everything, 'OK' for OUT commands and ERR_x for
+    stuff it does not understand.
+    '''
+    def handle(self,command):
+        command = command.decode(errors='replace').strip()
+        if command == 'IN PV 00':
+            reply = '%06.2f' % self.internal
+        elif command == 'IN PV 01':
+            if self.external is None:
+                reply = 'ERR_8'
+            else:
+                reply = '%06.2f' % self.external_temperature
+        elif command == 'IN SP 00':
+            reply = '%06.2f' % self.thermal.setpoint
+        elif command == 'IN MODE 01':
+            reply = '0'
+        elif command == 'IN MODE 02':
+            reply = '%i' % (not self.thermal.running)
+        elif command == 'TYPE':
+            reply = 'E200'
+        elif command == 'VERSION':
+            reply = 'V1.00'
+        elif command.startswith('OUT SP 00 '):
+            try:
+                self.thermal.temperature()
+                self.thermal.setpoint = round(float(command.split()[3]),2)
+                reply = 'OK'
+            except ValueError:
+                reply = 'ERR_5'
+        elif command.startswith('OUT SP 01 '):
+            reply = 'OK'
+        elif command in ('START','STOP'):
+            self.thermal.temperature()
+            self.thermal.running = command == 'START'
+            reply = 'OK'
+        else:
+            reply = 'ERR_3'
+        return (reply+'\r\n').encode()
+
+
+class SimulatedElectric(SimulatedBath):
+    '''
+    The electric (peltier) controller: three banks with their own set
+    temperature, frames look like STX ... ETX BCC. See electric._datagenelec.
+    '''
+    def __init__(self,T=20.0,tau=300.0,speedup=1.0,**options):
+        super().__init__(T,tau,speedup,**options)
+        self.banks = dict( (bank,_Thermal(T,tau,speedup)) for bank in (1,2,3) )
+
+    def _split_commands(self,data):
+        commands = []
+        while True:
+            end = data.find(b'\x03')
+            if end == -1 or end+1 >= len(data):
+                return commands, data
+            commands.append(data[:end+2])
+            data = data[end+2:]
+
+    def _frame(self,text):
+        data = b'\x02' + text.encode() + b'\x03'
+        bcc = 0
+        for b in data[1:]:
+            bcc = bcc ^ b
+        return data + bytes([bcc])
+
+    def handle(self,frame):
+        start = frame.find(b'\x02')
+        if start == -1:
+            return None
+        frame = frame[start:]
+        bcc = 0
+        for b in frame[1:-1]:
+            bcc = bcc ^ b
+        text = frame[1:-2].decode(errors='replace')
+        node = text[0:2]
+        if bcc != frame[-1]:
+            return self._frame(node + '00' + '10')    # Parity/BCC error
+        bank = self.banks.get(int(node) if node.isdigit() else 0)
+        mrcsrc = text[5:9]
+        if bank is None:
+            return None     # Nobody at that address
+        if mrcsrc == '0102':
+            bank.temperature()
+            value = int(text[21:],16)
+            if value >= 0x80000000:     # Two's complement
+                value = value - 0x100000000
+            bank.setpoint = value/100
+            return self._frame(node + '00' + '00' + '0102' + '0000')
+        elif mrcsrc == '0101':
+            if text[9:11] == 'C0':
+                value = bank.temperature()
+            else:
+                value = bank.setpoint
+            return self._frame(node + '00' + '00' + '0101' + '0000' + '%08X' % (int(round(value*100)) & 0xFFFFFFFF))
+        return self._frame(node + '00' + '00' + mrcsrc + '0401')    # Unsupported command
+
+
+class SimulatedThermo(SimulatedBath):
+    '''
+    The mysterious Thermo: only reading the set temperature is used.
+    '''
+    def handle(self,command):
+        command = command.decode(errors='replace').strip()
+        if command == 'RS':
+            return ('RS %05.2f\r' % self.thermal.setpoint).encode()
+        elif command == 'RT':
+            return ('RT %05.2f\r' % self.internal).encode()
+        elif command.startswith('SS '):
+            self.thermal.temperature()
+            self.thermal.setpoint = float(command[3:])
+            return b'\r'
+        return b'?\r'
+
+
+MODELS = {
+    'julabo'       : SimulatedJulabo,
+    'haakeF6'      : SimulatedHaake,
+    'haakePhoenix' : SimulatedHaake,
+    'LaudaE200'    : SimulatedLauda,
+    'electric'     : SimulatedElectric,
+    'thermo'       : SimulatedThermo,
+}
+
+_devices = {}
+
+
+def simulate(model,name=None,**options):
+    '''
+    Makes a new simulated device of model (one of MODELS, named like the
+    classes in classywaterbaths.py), and returns the comport to give to that
+    class. See the top of this file for the options.
+    '''
+    if model not in MODELS:
+        raise ValueError("Unknown model '%s', choose from %s" % (model,', '.join(MODELS)))
+    if name is None:
+        n = 1
+        while '%s-%i' % (model,n) in _devices:
+            n = n + 1
+        name = '%s-%i' % (model,n)
+    _devices[name] = MODELS[model](**options)
+    return 'sim://' + name
+
+
+def get_device(comport):
+    '''
+    Returns the simulated device behind a 'sim://name' comport (or just name),
+    so you can look at or change its state. A name that is a model (like
+    'sim://julabo') gets a device with default options the first time.
+    '''
+    name = comport.split('://',1)[-1].split('?')[0]
+    if name not in _devices:
+        if name not in MODELS:
+            raise serial.SerialException("No simulated device called '%s'" % (name,))
+        _devices[name] = MODELS[name]()
+    return _devices[name]
+
+
+class SimulatedSerial(serial.SerialBase):
+    '''
+    Looks like a pyserial Serial object, but talks to a simulated device.
+    Timing follows the baudrate, bytesize, parity and stopbits it is opened
+    with.
+    '''
+    def open(self):
+        if self._port is None:
+            raise serial.SerialException("Port must be configured before it can be used.")
+        if self.is_open:
+            raise serial.SerialException("Port is already open.")
+        self.device = get_device(self._port)
+        self._generation = self.device.generation
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def _reconfigure_port(self,*args,**kwargs):
+        pass
+
+    def _check_open(self):
+        if not self.is_open:
+            raise serial.SerialException("Attempting to use a port that is not open")
+        if self._generation != self.device.generation:
+            raise serial.SerialException("WriteFile failed (device disconnected)")
+
+    def _char_time(self):
+        parity = 0 if self._parity == serial.PARITY_NONE else 1
+        return (1 + self._bytesize + parity + self._stopbits) / self._baudrate
+
+    @property
+    def in_waiting(self):
+        self._check_open()
+        return self.device.available(time.perf_counter())
+
+    def read(self,size=1):
+        self._check_open()
+        deadline = None if self._timeout is None else time.perf_counter() + self._timeout
+        data = b''
+        while len(data) < size:
+            data = data + self.device.take(size-len(data),time.perf_counter())
+            if len(data) >= size:
+                break
+            now = time.perf_counter()
+            if deadline is not None and now >= deadline:
+                break
+            tnext = self.device.next_arrival()
+            if tnext is None:
+                tnext = now + 0.01
+            if deadline is not None:
+                tnext = min(tnext,deadline)
+            time.sleep(max(0,tnext-now))
+        return data
+
+    def write(self,data):
+        self._check_open()
+        data = bytes(data)
+        if self.device.baudrate not in (None,self._baudrate):
+            return len(data)    # Noise to the device
+        self.device.receive(data,time.perf_counter(),self._char_time())
+        return len(data)
+
+    def reset_input_buffer(self):
+        self._check_open()
+        self.device.discard(time.perf_counter())
+
+    def reset_output_buffer(self):
+        self._check_open()
+
+
+def _register():
+    '''
+    Lets serial.serial_for_url() open 'sim://' comports with SimulatedSerial.
+    pyserial looks for a module called 'protocol_sim' in the packages in
+    serial.protocol_handler_packages.
+    '''
+    handler = types.ModuleType(__name__ + '.protocol_sim')
+    handler.Serial = SimulatedSerial
+    sys.modules[handler.__name__] = handler
+    if __name__ not in serial.protocol_handler_packages:
+        serial.protocol_handler_packages.append(__name__)
+
+_register()
@@ -0,0 +1,178 @@
+'''
+Recording temperatures for a long time, without the text log.
+
+Temperature_controller.passive_logging() writes every sample as a line in
+tempcontroller_info.log. That is nice to read, but if you log every few seconds
+for weeks, the log becomes huge and slow to load. The TelemetryRecorder here
+keeps the newest samples in memory (so you can look at them directly), and
+writes them to disk in chunks of binary NumPy files:
+
+    ju = julabo('com4')
+    rec = TelemetryRecorder(ju,'telemetry_julabo')
+    rec.run(time_interval=5)        # ctrl+c to stop
+
+    data = load_telemetry('telemetry_julabo')
+    plot(data['time'],data['T_internal'])
+
+Every chunk is a separate .npy file, that is never changed after it is written,
+so stopping (or crashing) halfway only loses the samples that were not flushed
+yet. This requires NumPy.
+'''
+
+import glob
+import logging
+import math
+import os
+import time
+
+import numpy as np
+
+from classywaterbaths import PRIORITY_TELEMETRY
+
+# One sample: time in seconds since the epoch (time.time()), and the three
+# temperatures in deg C. Failed readings are stored as NaN.
+SAMPLE_DTYPE = np.dtype([('time','<f8'),
+                         ('T_internal','<f8'),
+                         ('T_external','<f8'),
+                         ('T_set','<f8')])
+
+
+class TelemetryRecorder():
+    '''
+    Samples internal, external and set temperature of a controller into a ring
+    buffer of 'capacity' samples, and writes them to 'directory' every
+    'chunk_size' samples.
+
+    IN:
+        * controller : Temperature_controller to record, i.e. julabo('com4').
+        * directory  : Folder to put the chunk files in. Is created if needed,
+                       and existing chunks are kept (we just add to them).
+        * capacity   : Number of samples kept in memory.
+        * chunk_size : Number of samples per file on disk. Should be smaller
+                       than capacity.
+    '''
+    def __init__(self,controller,directory='telemetry',capacity=100000,chunk_size=1000):
+        if chunk_size > capacity:
+            raise ValueError("chunk_size (%i) cannot be larger than capacity (%i)" % (chunk_size,capacity))
+        self.controller = controller
+        self.directory = directory
+        self.capacity = capacity
+        self.chunk_size = chunk_size
+        self.buffer = np.full(capacity,np.nan,dtype=SAMPLE_DTYPE)
+        self.count = 0      # Total number of samples added
+        self.flushed = 0    # Total number of samples written to disk
+        os.makedirs(directory,exist_ok=True)
+        self._chunk = len(self._chunk_files(directory))
+
+    def __repr__(self):
+        return " <TelemetryRecorder of %s, %i samples, %i on disk>" % (repr(self.controller),self.count,self.flushed)
+
+    @staticmethod
+    def _chunk_files(directory):
+        return sorted(glob.glob(os.path.join(directory,'chunk_*.npy')))
+
+    def _read(self,reader):
+        try:
+            return float(reader())
+        except Exception as e:
+            logging.warning("Telemetry reading failed: '%s'" % str(e))
+            return math.nan
+
+    def sample(self):
+        '''
+        Reads the temperatures once and adds them to the buffer. Returns the
+        sample. If reading all three at once fails, they are read one by one,
+        so only the channel that fails becomes NaN.
+        '''
+        t = time.time()
+        with self.controller.priority(PRIORITY_TELEMETRY):
+            try:
+                temperatures = self.controller.read_all()
+            except Exception as e:
+                logging.warning("Telemetry reading failed: '%s', reading the channels one by one" % str(e))
+                Ti = self._read(self.controller._readtemp_internal)
+                Te = self._read(self.controller._readtemp_external)
+                Ts = self._read(self.controller._readtemp_set)
+                return self.add(t,Ti,Te,Ts)
+        return self.add(t,temperatures['T_internal'],temperatures['T_external'],temperatures['T_set'])
+
+    def add(self,t,Ti,Te,Ts):
+        '''
+        Adds a sample you got somewhere else to the buffer. Flushes to disk if
+        a chunk is full.
+        '''
+        self.buffer[self.count % self.capacity] = (t,Ti,Te,Ts)
+        self.count = self.count + 1
+        if self.count - self.flushed >= self.chunk_size:
+            self.flush()
+        return self.buffer[(self.count-1) % self.capacity]
+
+    def latest(self,n=None):
+        '''
+        Returns a copy of the newest n samples (all samples in memory if None),
+        oldest first.
+        '''
+        available = min(self.count,self.capacity)
+        if n is None or n > available:
+            n = available
+        indices = np.arange(self.count-n,self.count) % self.capacity
+        return self.buffer[indices]
+
+    def flush(self):
+        '''
+        Writes all samples that are not on disk yet to a new chunk file.
+        '''
+        n = self.count - self.flushed
+        if n == 0:
+            return
+        if n > self.capacity:
+            logging.warning("Telemetry buffer overflowed, %i samples were lost" % (n-self.capacity,))
+            n = self.capacity
+        data = self.latest(n)
+        filename = os.path.join(self.directory,'chunk_%06i.npy' % (self._chunk,))
+        # Write to temporary file first, so we never leave half a chunk behind.
+        temporary = filename + '.tmp'
+        with open(temporary,'wb') as f:
+            np.save(f,data)
+        os.replace(temporary,filename)
+        logging.debug("Wrote %i telemetry samples to '%s'" % (n,filename))
+        self._chunk = self._chunk + 1
+        self.flushed = self.count
+
+    def run(self,time_interval=5,duration=None,verbose=False):
+        '''
+        Samples every time_interval seconds, until duration seconds have passed
+        (or forever if None, stop with ctrl+c). Whatever is left in the buffer
+        is written to disk when we stop.
+        '''
+        print("Starting telemetry recording: every %f seconds into '%s'. Press ctrl+c to stop." % (time_interval,self.directory))
+        logging.info("Start telemetry recording into '%s'" % (self.directory,))
+        t0 = time.perf_counter()
+        k = 0
+        try:
+            while duration is None or k*time_interval < duration:
+                self.controller._sleep_until(t0 + k*time_interval)
+                sample = self.sample()
+                if verbose:
+                    print("T_internal = %s, T_external = %s, T_set = %s" % (sample['T_internal'],sample['T_external'],sample['T_set']))
+                k = k + 1
+                if time.perf_counter() > t0 + k*time_interval:
+                    # Reading took longer than time_interval, do not try to catch up.
+                    logging.warning("Telemetry sampling is behind schedule, time_interval is too short")
+                    k = int(math.ceil((time.perf_counter()-t0)/time_interval))
+        except KeyboardInterrupt:
+            print("Stopped telemetry recording.")
+        finally:
+            self.flush()
+            logging.info("Stopped telemetry recording, %i samples on disk" % (self.flushed,))
+
+
+def load_telemetry(directory):
+    '''
+    Reads all chunks in directory back into one array (with fields 'time',
+    'T_internal', 'T_external' and 'T_set'), oldest first.
+    '''
+    files = TelemetryRecorder._chunk_files(directory)
+    if not files:
+        return np.zeros(0,dtype=SAMPLE_DTYPE)
+    return np.concatenate([np.load(f) for f in files])